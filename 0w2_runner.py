@@ -1,10 +1,20 @@
-from dashboard import load_and_process_data, process_bike_data
+# 0w2_runner.py
+# Headless runner for the Pi Zero 2 W: prints the regression summary of a run in one constant-memory pass
+# Usage: python 0w2_runner.py run_data/testrun1.txt bike_profiles/full_range_values.txt
+#        cat RUN7.TXT | python 0w2_runner.py - bike_profiles/wills_megatower.txt
 
+from accelerometer_data_processor import process_bike_data, summarise_run_stream
+import sys
 
-def print_data():
-    text_file = "run_data/testrun1.txt"
-    bike_file = "bike_profiles/full_range_values.txt"
+
+def print_data(text_file="run_data/testrun1.txt", bike_file="bike_profiles/full_range_values.txt"):
     bike_data = process_bike_data(bike_file)
-    data = load_and_process_data(text_file, bike_data)
-    print(data["textData"])
-print_data()
\ No newline at end of file
+    if text_file == "-":
+        text_data, _, _ = summarise_run_stream(sys.stdin, bike_data)
+    else:
+        with open(text_file, "r") as f:
+            text_data, _, _ = summarise_run_stream(f, bike_data)
+    print(text_data)
+
+
+print_data(*sys.argv[1:3])
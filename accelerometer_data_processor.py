@@ -1,34 +1,125 @@
+# Headless core: run parsing, analysis and bike profiles. Must not import plotting code, see startup_benchmark.py
 import os.path
-
-def find_displacement_speed(arr1, arr2, arr1_times, arr2_times):
+from dataclasses import dataclass, field
+from itertools import islice, repeat
+import threading
+import numpy as np
+from instrumentation import instrumented
+from spectral import RunSpectra, run_spectra, sample_rate
+from histograms import TravelHistogram, travel_histogram
+from robust_regression import REGRESSION_METHODS, SlopeFit, ols_fit, theil_sen
+from run_schema import ACCEL_COLUMNS, DEFAULT_SCHEMA, SHOCK, FORK, RunSchema, SampledChannel, TimeAxis
+from run_format import MAGIC, BinaryRun, is_binary_run
+
+__all__ = [
+    "process_bike_data", "process_accelerometer_file", "process_run_file", "process_runs", "summarise_run_stream", "RunResult", "ChannelResult",
+    "process_raw_run", "read_run_file", "parse_run_text", "parse_run_content", "parse_adc_rows", "normalise", "RunFileTail",
+    "turning_points", "TurningPointTracker", "find_displacement_speed", "get_line_data",
+    "linear_regression", "RegressionAccumulator", "ChannelSummary", "format_data", "SlopeFit",
+]
+
+@instrumented("pairing", samples=lambda args, result: len(args[0]))
+def find_displacement_speed(arr1, arr2, arr1_times, arr2_times, min_displacement=1):
     # Uses gradient between turning points to find time, total displacement and speed of compression/rebound
     # compression = (peaks, troughs) and rebound = (troughs, peaks)
-    times, speeds, displacements = [], [], []
-
-    # Determine starting point in second array
-    for i, value in enumerate(arr2_times):
-        if value > arr1_times[0]:
-            startIndex = i
-            break
-
-    itterations = min(len(arr1), len(arr2) - startIndex)
-
-    for i in range(itterations):
-        val1 = arr1[i]
-        time1 = arr1_times[i]
-        val2 = arr2[i + startIndex]
-        time2 = arr2_times[i + startIndex]
-        displacement = abs(val2 - val1)
-        if displacement > 1:  # Filter out small displacements (vibrations)
-            times.append(time1)
-            speeds.append(abs(displacement / (time2 - time1)))
-            displacements.append(displacement)
+    arr1, arr2 = np.asarray(arr1, dtype=np.float64), np.asarray(arr2, dtype=np.float64)
+    arr1_times, arr2_times = np.asarray(arr1_times, dtype=np.float64), np.asarray(arr2_times, dtype=np.float64)
+    if len(arr1) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+
+    # Determine starting point in second array (first turning point strictly after the first in arr1)
+    startIndex = np.searchsorted(arr2_times, arr1_times[0], side="right")
+    itterations = max(min(len(arr1), len(arr2) - startIndex), 0)
+
+    time1 = arr1_times[:itterations]
+    time2 = arr2_times[startIndex:startIndex + itterations]
+    displacement = np.abs(arr2[startIndex:startIndex + itterations] - arr1[:itterations])
+
+    # Filter out small displacements (vibrations)
+    keep = displacement > min_displacement
+    displacements = displacement[keep]
+    times = time1[keep]
+    # Without a run time (no footer) every turning point is at 0 s, such speeds are NaN rather than a division by zero
+    durations = time2[keep] - times
+    speeds = np.full(len(displacements), np.nan)
+    np.divide(displacements, durations, out=speeds, where=durations > 0)
+    speeds = np.abs(speeds)
 
     return times, speeds, displacements
 
 
-def turning_points(array, acceptance):
+@instrumented("turning_points", samples=lambda args, result: len(args[0]))
+def turning_points(array, acceptance, reference=False):
     # Returns all indexes of turning points in 1D array. Acceptance is the minimum change for turning point to be not considered vibration
+    # Vectorised over the whole array; reference=True runs the original sample-by-sample loop for equivalence testing
+    if reference:
+        return _turning_points_reference(array, acceptance)
+
+    return TurningPointTracker(acceptance).update(array)
+
+
+class TurningPointTracker:
+    # Runs the turning_points state machine over a signal that arrives in chunks, keeping the hysteresis state between them
+    def __init__(self, acceptance):
+        self.acceptance = acceptance
+        self.count = 0  # Samples seen so far
+        self.last = None  # Last sample, paired with the first sample of the next chunk
+        self.begin = 1  # Index of the last non-neutral pair
+        self.state = 0  # State of the last non-neutral pair: +1 RISING, -1 FALLING, 0 NEUTRAL
+        # Samples from the earliest index a future turning point can sit at, the midpoint rule can look back past the chunk
+        self.history = np.zeros(0)
+        self.historyStart = 0
+
+    def update(self, chunk):
+        # Returns (idx_min, idx_max) of turning points confirmed by this chunk, as indexes into the whole signal
+        # Their samples are available from values() until the next update
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if len(chunk) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+        keepFrom = self.settled() if self.count else 0
+        self.history = np.concatenate((self.history[keepFrom - self.historyStart:], chunk))
+        self.historyStart = keepFrom
+
+        if self.last is None:
+            values, firstPair = chunk, 1
+        else:
+            values, firstPair = np.concatenate(([self.last], chunk)), self.count
+        self.count += len(chunk)
+        self.last = chunk[-1]
+
+        # State of each consecutive pair (values[k - 1], values[k])
+        diff = values[:-1] - values[1:]
+        states = (diff > self.acceptance).astype(np.int8) - (-diff > self.acceptance).astype(np.int8)
+
+        # Only non-neutral pairs move the state machine on; a turning point sits midway between two opposite states
+        nonNeutral = np.flatnonzero(states)
+        changes = nonNeutral + firstPair
+        changeStates = states[nonNeutral]
+        if self.state != 0:
+            changes = np.concatenate(([self.begin], changes))
+            changeStates = np.concatenate(([self.state], changeStates))
+        if len(changes):
+            self.begin, self.state = int(changes[-1]), int(changeStates[-1])
+
+        flips = np.flatnonzero(changeStates[1:] != changeStates[:-1]) + 1
+        midpoints = (changes[flips - 1] + changes[flips] - 1) // 2
+        fallingAfter = changeStates[flips] < 0
+
+        return midpoints[~fallingAfter], midpoints[fallingAfter]
+
+    def settled(self):
+        # Earliest sample index a future turning point can still sit at: the midpoint rule looks back to the last
+        # non-neutral pair, or only to the last sample when there is none
+        return (self.begin + self.count - 1) // 2 if self.state else self.count - 1
+
+    def values(self, indexes):
+        # Samples at turning point indexes returned by the last update
+        return self.history[np.asarray(indexes, dtype=np.intp) - self.historyStart]
+
+
+def _turning_points_reference(array, acceptance):
+    # Pure-Python state machine that turning_points is vectorised from
     idx_max, idx_min = [], []
 
     NEUTRAL, RISING, FALLING = range(3)
@@ -40,6 +131,9 @@ def turning_points(array, acceptance):
             return FALLING
         return NEUTRAL
 
+    if len(array) < 2:
+        return idx_min, idx_max
+
     ps = get_state(array[0], array[1])
     begin = 1
     for i in range(2, len(array)):
@@ -56,153 +150,516 @@ def turning_points(array, acceptance):
     return idx_min, idx_max
 
 
-def process_accelerometer_file(file, bike_data):
-    # Main function to process file into dict of key values
-    shock_min_value = bike_data[0]
-    shock_max_value = bike_data[1]
-    fork_min_value = bike_data[2]
-    fork_max_value = bike_data[3]
-
+@instrumented("parse", samples=lambda args, result: len(result[2]))
+def read_run_file(file):
+    # Reads a text or binary run file in a single pass. Returns header, initial values line, raw shock/fork ADC arrays, run time (s),
+    # chassis acceleration and the other header channels (code -> raw samples at the channel's own rate)
+    with open(file, "rb") as f:
+        binary = is_binary_run(f.read(len(MAGIC)))
+    if binary:
+        return parse_binary_run(BinaryRun.open(file))
+    with open(file, "r") as f:
+        return parse_run_text(f.read())
+
+
+def parse_run_content(content):
+    # Parses the bytes of a text or binary run, e.g. an upload, as read_run_file does
+    if is_binary_run(content):
+        return parse_binary_run(BinaryRun(content))
+    return parse_run_text(content.decode("utf-8"))
+
+
+def parse_binary_run(run):
+    # Raw run from a BinaryRun. Acceleration stays a view of its buffer, travel and the other channels are converted to the
+    # dtypes parse_adc_rows gives (float64 travel, float32 channels), the latter still views when stored as float32
+    shock = run.column(SHOCK).astype(np.float64)
+    fork = run.column(FORK).astype(np.float64)
+
+    # Values of 1024 or more are sensor errors
+    shock[shock >= 1024] = 0
+    fork[fork >= 1024] = 0
+
+    channels = {channel.code: run.channel(channel.code).astype(np.float32, copy=False) for channel in run.schema.other_channels}
+    return run.header, run.initialValues, shock, fork, run.timeOfRun, run.accel, channels
+
+
+def parse_run_text(text):
+    # Parses the text of a whole run (header, initial values, data rows, footer), chassis acceleration and every header channel included
+    parts = text.split("\n", 2)
+    parts += [""] * (3 - len(parts))
+    header = parts[0].rstrip("\r")
+    initialValues = parts[1].rstrip().split(',')
+    lines = parts[2].splitlines()
+
+    # Footer (total run time in ms and "Run finished") are the only lines without commas
+    dataEnd = len(lines)
+    while dataEnd > 0 and ',' not in lines[dataEnd - 1]:
+        dataEnd -= 1
+
+    timeOfRun = 0
+    for line in lines[dataEnd:]:
+        if line.strip() and line != 'Run finished':
+            timeOfRun = int(line) / 1000
+
+    shock, fork, accel, channels = parse_adc_rows(lines[:dataEnd], accel=True, schema=RunSchema.from_header(header))
+    return header, initialValues, shock, fork, timeOfRun, accel, channels
+
+
+def parse_adc_rows(rows, accel=False, schema=DEFAULT_SCHEMA):
+    # Parses data rows into raw shock and fork ADC arrays from the columns the header schema gives them, other columns are skipped
+    # With accel the chassis accelerometer (0-2, m/s^2) is read in the same pass and returned third as a float32 (samples x 3) array,
+    # and the schema's other channels fourth (code -> float32 array keeping every decimation-th row, never upsampled)
+    others = schema.other_channels if accel else []
+    columns = (ACCEL_COLUMNS if accel else ()) + schema.travel_columns + tuple(channel.column for channel in others)
+    if len(rows) == 0:
+        adc = np.zeros((0, len(columns)))
+    else:
+        adc = np.loadtxt(rows, delimiter=",", usecols=columns, dtype=np.float64, ndmin=2)
+    travel = len(columns) - len(others) - 2
+    shock = adc[:, travel].copy()
+    fork = adc[:, travel + 1].copy()
+
+    # Values of 1024 or more are sensor errors
+    shock[shock >= 1024] = 0
+    fork[fork >= 1024] = 0
+
+    if accel:
+        channels = {channel.code: adc[::channel.decimation, travel + 2 + i].astype(np.float32) for i, channel in enumerate(others)}
+        return shock, fork, adc[:, :3].astype(np.float32), channels
+    return shock, fork
+
+
+class RunFileTail:
+    # Follows a run file that is still being written, parsing only the bytes appended since the last read
+    def __init__(self, file):
+        self.file = file
+        self.offset = 0
+        self.partial = ""  # Incomplete last line, finished by the next read
+        self.header = None
+        self.initialValues = None
+        self.timeOfRun = None
+        self.finished = False
+        self.count = 0  # Data rows read so far
+
+    def read_new(self):
+        # Returns raw shock and fork ADC arrays for the complete rows written since the last call
+        if not os.path.exists(self.file):
+            return np.zeros(0), np.zeros(0)
+
+        with open(self.file, "r", newline="") as f:
+            f.seek(self.offset)
+            new = f.read()
+            self.offset = f.tell()
+
+        lines = (self.partial + new).split("\n")
+        self.partial = lines.pop()
+
+        rows = []
+        for line in lines:
+            line = line.rstrip("\r")
+            if self.header is None:
+                self.header = line
+            elif self.initialValues is None:
+                self.initialValues = line.split(',')
+            elif ',' in line:
+                rows.append(line)
+            elif line == 'Run finished':
+                self.finished = True
+            elif line.strip():
+                self.timeOfRun = int(line) / 1000
+
+        shock, fork = parse_adc_rows(rows, schema=RunSchema.from_header(self.header or ""))
+        self.count += len(shock)
+        return shock, fork
+
+
+def process_bike_data(file_path):
+    # Reads shock/fork min and max ADC readings from a bike profile
+    values = []
+
+    with open(file_path, 'r') as file:
+        for line in file:
+            parts = line.strip().split(":")  # Split by ':'
+            if len(parts) == 2:  # Ensure there are two parts (key and value)
+                key, value = parts[0].strip(), parts[1].strip()
+                if key in ["rear_sus_min", "rear_sus_max", "front_sus_min", "front_sus_max"]:
+                    values.append(int(value))  # Convert to integer and store
+
+    return values
+
+
+@instrumented("normalise", samples=lambda args, result: len(result))
+def normalise(values, min_value, max_value):
+    # Maps raw ADC values onto percentage travel for a bike profile
+    return ((values - min_value) / (max_value - min_value)) * 100
+
+
+@instrumented("process", samples=lambda args, result: len(result.time) if result else 0)
+def process_accelerometer_file(file, bike_data, min_displacement=1, regression="ols"):
+    # Main function to process file into a RunResult. min_displacement (%) filters vibrations out of compression/rebound
+    # regression is "ols" (least squares) or "theil-sen" (robust to glitched turning points) for the compression/rebound slopes
     if not os.path.exists(file):
         print(f"File '{file}' not found")
         return None
 
-    with open(file, "r") as f:
-        lineCount = len(f.readlines()) - 4  # Discount header and footer
+    header, initialValues, shockRaw, forkRaw, timeOfRun, accel, channels = read_run_file(file)
+    return process_raw_run(shockRaw, forkRaw, timeOfRun, bike_data, min_displacement, accel, header, regression, channels)
 
-    with open(file, "r") as f:
-        yShockValues, yForkValues = [], []
-        f.readline()  # Skip header
-        initialValues = f.readline().split(',')
-        for accelerometerInstance in f:
-            accelerometerList = accelerometerInstance.split(",")
-            if len(accelerometerList) != 1:
-                shock_value = float(accelerometerList[6])
-                fork_value = float(accelerometerList[7])
-                if shock_value >= 1024:
-                    shock_value = 0
-                if fork_value >= 1024:
-                    fork_value = 0
-                yShockValues.append(
-                    ((shock_value - shock_min_value) / (shock_max_value - shock_min_value)) * 100
-                )
-                yForkValues.append(
-                    ((fork_value - fork_min_value) / (fork_max_value - fork_min_value)) * 100
-                )
-            elif accelerometerInstance != 'Run finished\n':
-                timeOfRun = int(accelerometerInstance) / 1000
-    # Generate xValues without numpy
-    xValues = [i * (timeOfRun / lineCount) for i in range(lineCount)]
-    shock = get_line_data(xValues, yShockValues)
-    fork = get_line_data(xValues, yForkValues)
-    textData = format_data(shock[0], fork[0])
-
-    return {
-        "textData": ensure_non_empty(textData),
-        "timeOfRun": ensure_non_empty(timeOfRun),
-        "xValues": ensure_non_empty(xValues),
-        "yForkValues": ensure_non_empty(yForkValues),
-        "yShockValues": ensure_non_empty(yShockValues),
-        "forkPeakTimes": ensure_non_empty(fork[1][0]),
-        "forkPeaks": ensure_non_empty(fork[1][1]),
-        "forkTroughTimes": ensure_non_empty(fork[1][2]),
-        "forkTroughs": ensure_non_empty(fork[1][3]),
-        "forkCompressionSpeed": ensure_non_empty(fork[2][0]),
-        "forkCompressionDisplacement": ensure_non_empty(fork[2][1]),
-        "forkCompression_regress": ensure_non_empty(fork[2][2]),
-        "forkReboundSpeed": ensure_non_empty(fork[3][0]),
-        "forkReboundDisplacement": ensure_non_empty(fork[3][1]),
-        "forkRebound_regress": ensure_non_empty(fork[3][2]),
-        "shockPeakTimes": ensure_non_empty(shock[1][0]),
-        "shockPeaks": ensure_non_empty(shock[1][1]),
-        "shockTroughTimes": ensure_non_empty(shock[1][2]),
-        "shockTroughs": ensure_non_empty(shock[1][3]),
-        "shockCompressionSpeed": ensure_non_empty(shock[2][0]),
-        "shockCompressionDisplacement": ensure_non_empty(shock[2][1]),
-        "shockCompression_regress": ensure_non_empty(shock[2][2]),
-        "shockReboundSpeed": ensure_non_empty(shock[3][0]),
-        "shockReboundDisplacement": ensure_non_empty(shock[3][1]),
-        "shockRebound_regress": ensure_non_empty(shock[3][2]),
-    }
-
-def ensure_non_empty(value):
-    """Returns value if it's non-empty; otherwise, returns [0]."""
-    return value if value else [0]
-
-
-def get_line_data(x, y):
-    # Function processes individual line (fork and shock split)
-    peakIndexes, _ = turning_points(y, 0.1)
-    troughIndexes, _ = turning_points([-val for val in y], 0.1)
-    peaks = [y[i] for i in peakIndexes]
-    troughs = [y[i] for i in troughIndexes]
-    peakTimes = [x[i] for i in peakIndexes]
-    troughTimes = [x[i] for i in troughIndexes]
-
-    compression = get_compression_and_rebound(troughs, peaks, troughTimes, peakTimes)
-    rebound = get_compression_and_rebound(peaks, troughs, peakTimes, troughTimes)
-
-    # Data for text, peaks and troughs, compression, rebound
-    return [max(y), min(y), sum(y) / len(y), compression[0], rebound[0]], [peakTimes, peaks, troughTimes, troughs], \
-    compression[1], rebound[1]
-
-
-def get_compression_and_rebound(a, b, c, d):
+
+def process_run_file(file, bike_data, min_displacement=1, regression="ols"):
+    # process_accelerometer_file that also returns the raw run it parsed, for callers caching raw arrays. (raw, result)
+    header, initialValues, shockRaw, forkRaw, timeOfRun, accel, channels = raw = read_run_file(file)
+    return raw, process_raw_run(shockRaw, forkRaw, timeOfRun, bike_data, min_displacement, accel, header, regression, channels)
+
+
+def process_raw_run(shockRaw, forkRaw, timeOfRun, bike_data, min_displacement=1, accel=None, header="", regression="ols", channels=None):
+    # Analyses raw shock/fork ADC arrays for a bike profile into a RunResult, no file access
+    # Spectra are included when the chassis acceleration is given. channels (code -> raw samples) are kept on their own time axes
+    shock_min_value = bike_data[0]
+    shock_max_value = bike_data[1]
+    fork_min_value = bike_data[2]
+    fork_max_value = bike_data[3]
+    lineCount = len(shockRaw)
+
+    yShockValues = normalise(shockRaw, shock_min_value, shock_max_value)
+    yForkValues = normalise(forkRaw, fork_min_value, fork_max_value)
+    time = TimeAxis.for_run(lineCount, timeOfRun)
+    shock = get_line_data(time, yShockValues, min_displacement, regression)
+    fork = get_line_data(time, yForkValues, min_displacement, regression)
+    sample_time = timeOfRun / lineCount if lineCount else 0
+    shock.histogram = travel_histogram(yShockValues, sample_time)
+    fork.histogram = travel_histogram(yForkValues, sample_time)
+    textData = format_data(shock.summary(), fork.summary(), shock.intervals(), fork.intervals())
+    spectra = None
+    if accel is not None:
+        spectra = run_spectra(yForkValues, yShockValues, accel, sample_rate(lineCount, timeOfRun, header))
+
+    schema = RunSchema.from_header(header)
+    sampled = {code: SampledChannel(schema.channel(code), values, TimeAxis.for_run(lineCount, timeOfRun, schema.channel(code).decimation))
+               for code, values in (channels or {}).items()}
+    return RunResult(textData, timeOfRun, time, fork, shock, spectra, sampled)
+
+
+@dataclass(slots=True)
+class ChannelResult:
+    # Travel, turning points and compression/rebound of one channel (fork or shock). Arrays may be empty, never padded
+    values: np.ndarray  # Travel (%) per sample, float32
+    peakTimes: np.ndarray
+    peaks: np.ndarray
+    troughTimes: np.ndarray
+    troughs: np.ndarray
+    compressionSpeed: np.ndarray
+    compressionDisplacement: np.ndarray
+    compressionRegress: np.ndarray
+    compression: "RegressionAccumulator"
+    reboundSpeed: np.ndarray
+    reboundDisplacement: np.ndarray
+    reboundRegress: np.ndarray
+    rebound: "RegressionAccumulator"
+    maximum: float
+    minimum: float
+    mean: float
+    histogram: TravelHistogram | None = None  # Travel/velocity histograms, set once the sample time is known
+    compressionFit: SlopeFit | None = None  # Reported slope fits with confidence intervals, least squares when not set
+    reboundFit: SlopeFit | None = None
+
+    def summary(self):
+        # [max, min, mean, compression slope, rebound slope] as used by format_data
+        compression = self.compressionFit.slope if self.compressionFit else self.compression.slope()
+        rebound = self.reboundFit.slope if self.reboundFit else self.rebound.slope()
+        return [self.maximum, self.minimum, self.mean, compression, rebound]
+
+    def intervals(self):
+        # [compression, rebound] slope confidence intervals as used by format_data, None without fits
+        if self.compressionFit is None or self.reboundFit is None:
+            return None
+        return [self.compressionFit.interval(), self.reboundFit.interval()]
+
+    @property
+    def nbytes(self):
+        arrays = sum(getattr(self, name).nbytes for name in self.__slots__ if isinstance(getattr(self, name), np.ndarray))
+        return arrays + (self.histogram.nbytes if self.histogram else 0)
+
+
+@dataclass(slots=True)
+class RunResult:
+    # Processed run: per-channel results sharing one time axis
+    textData: str
+    timeOfRun: float
+    time: TimeAxis  # Sample times of the fork and shock travel
+    fork: ChannelResult
+    shock: ChannelResult
+    spectra: RunSpectra | None = None  # Frequency content, None when the chassis acceleration was not read
+    channels: dict = field(default_factory=dict)  # Other header channels, code -> SampledChannel at its own rate
+
+    @property
+    def xValues(self):
+        # Materialised sample times (s). Built on each call, use time where start, step and length are enough
+        return self.time.values()
+
+    @property
+    def nbytes(self):
+        return (self.time.nbytes + self.fork.nbytes + self.shock.nbytes + (self.spectra.nbytes if self.spectra else 0)
+                + sum(channel.nbytes for channel in self.channels.values()))
+
+    def channel(self, name):
+        # "fork" or "shock"
+        return self.fork if name == "fork" else self.shock
+
+
+_run_pool = None
+_run_pool_lock = threading.Lock()
+
+
+def run_pool(workers=None):
+    # Worker processes for process_runs, started on first use (with workers processes, default one per core) and kept
+    # Children come from a forkserver (spawn where there is none): forking the multi-threaded server could copy a held lock
+    global _run_pool
+    with _run_pool_lock:
+        if _run_pool is None:
+            import multiprocessing  # Imported here to keep headless cold start short
+            from concurrent.futures import ProcessPoolExecutor
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context("spawn")
+            _run_pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        return _run_pool
+
+
+def process_runs(files, bike_data, min_displacement=1, workers=None, regression="ols", raw=False):
+    # Processes several run files concurrently on the shared worker processes. Results keep the order of files
+    # With raw each result comes as (raw run, result), as from process_run_file
+    process = process_run_file if raw else process_accelerometer_file
+    if len(files) <= 1:
+        return [process(file, bike_data, min_displacement, regression) for file in files]
+    return list(run_pool(workers).map(process, files, repeat(bike_data), repeat(min_displacement), repeat(regression)))
+
+
+def get_line_data(x, y, min_displacement=1, regression="ols"):
+    # Function processes individual line (fork and shock split) into a ChannelResult. x holds the sample times, a TimeAxis or array
+    # Troughs of y are the peaks of -y, which the state machine reports as its second list
+    peakIndexes, troughIndexes = turning_points(y, 0.1)
+    peaks = y[peakIndexes]
+    troughs = y[troughIndexes]
+    peakTimes = x[peakIndexes]
+    troughTimes = x[troughIndexes]
+
+    compression = get_compression_and_rebound(troughs, peaks, troughTimes, peakTimes, min_displacement, regression)
+    rebound = get_compression_and_rebound(peaks, troughs, peakTimes, troughTimes, min_displacement, regression)
+
+    if len(y):
+        maximum, minimum, mean = float(np.max(y)), float(np.min(y)), float(np.mean(y))
+    else:
+        maximum = minimum = mean = float('nan')
+
+    return ChannelResult(
+        np.asarray(y, dtype=np.float32), peakTimes, peaks, troughTimes, troughs,
+        *compression[1], compression[2], *rebound[1], rebound[2], maximum, minimum, mean,
+        compressionFit=compression[3], reboundFit=rebound[3],
+    )
+
+
+def get_compression_and_rebound(a, b, c, d, min_displacement=1, regression="ols"):
     # Determines regression of turning points (once split into compression and rebound). Returns model for plot and variables for processing
-    data = find_displacement_speed(a, b, c, d)
+    # The accumulator is always least squares so runs can be merged, the SlopeFit uses the chosen regression method
+    if regression not in REGRESSION_METHODS:
+        raise ValueError(f"Unknown regression '{regression}', choose one of {REGRESSION_METHODS}")
+    data = find_displacement_speed(a, b, c, d, min_displacement)
     times = data[0]
     speed = data[1]
     displacement = data[2]
-    regressionModel = linear_regression(displacement, speed)
-    regressionResult = [regressionModel[0] * x + regressionModel[1] for x in displacement]
+    accumulator = fit_regression(displacement, speed)
+    fit = theil_sen(displacement, speed) if regression == "theil-sen" else ols_fit(accumulator, displacement, speed)
+    regressionModel = fit.slope, fit.intercept
+    regressionResult = regressionModel[0] * displacement + regressionModel[1]
 
-    return regressionModel[0], [speed, displacement, regressionResult]
+    return regressionModel[0], [speed, displacement, regressionResult], accumulator, fit
 
 
 def linear_regression(x, y):
-    # Determines linear regression of scatter
-    n = len(x)
-    sum_x = sum(x)
-    sum_y = sum(y)
-    sum_xy = sum(xi * yi for xi, yi in zip(x, y))
-    sum_xx = sum(xi * xi for xi in x)
-
-    try:
-        denominator = (n * sum_xx - sum_x * sum_x)
-        if denominator == 0:
-            raise ZeroDivisionError("Denominator for slope calculation is zero. Check input values.")
-
-        slope = (n * sum_xy - sum_x * sum_y) / denominator
-        intercept = (sum_y - slope * sum_x) / n if n != 0 else float('nan')  # Avoid division by zero
-
-    except ZeroDivisionError as e:
-        print(f"Error: {e}")
-        slope = float('nan')  # Assign NaN or a default value
-        intercept = float('nan')
-    except Exception as e:
-        print(f"Unexpected error: {e}")
-        slope = float('nan')
-        intercept = float('nan')
-
-    return slope, intercept
-
-
-def format_data(shock, fork):
-    # Formats key variables in clean way for text output
+    # Determines linear regression of scatter. Slope and intercept are NaN when x has no spread
+    accumulator = fit_regression(x, y)
+    return accumulator.slope(), accumulator.intercept()
+
+
+@instrumented("regression", samples=lambda args, result: len(args[0]))
+def fit_regression(x, y):
+    # Least squares fit of y against x as a RegressionAccumulator
+    return RegressionAccumulator().add(x, y)
+
+
+class RegressionAccumulator:
+    # Running least squares fit of y against x. Keeps centred sums so batches, runs and days can be merged without the raw points
+    def __init__(self, n=0, mean_x=0.0, mean_y=0.0, sxx=0.0, sxy=0.0, syy=0.0):
+        self.n = n
+        self.mean_x = mean_x
+        self.mean_y = mean_y
+        self.sxx = sxx  # Sum of squared deviations of x from its mean
+        self.sxy = sxy  # Sum of products of x and y deviations
+        self.syy = syy  # Sum of squared deviations of y, for the residuals of the fit
+
+    def add(self, x, y):
+        # Adds a batch of samples, returns self so calls can be chained
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if len(x) == 0:
+            return self
+        mean_x, mean_y = x.mean(), y.mean()
+        dx, dy = x - mean_x, y - mean_y
+        return self.merge(RegressionAccumulator(len(x), mean_x, mean_y, np.dot(dx, dx), np.dot(dx, dy), np.dot(dy, dy)))
+
+    def merge(self, other):
+        # Combines another accumulator into this one (parallel Welford update), returns self
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.mean_x, self.mean_y, self.sxx, self.sxy, self.syy = other.to_tuple()
+            return self
+        n = self.n + other.n
+        delta_x = other.mean_x - self.mean_x
+        delta_y = other.mean_y - self.mean_y
+        weight = self.n * other.n / n
+        self.sxx += other.sxx + delta_x * delta_x * weight
+        self.sxy += other.sxy + delta_x * delta_y * weight
+        self.syy += other.syy + delta_y * delta_y * weight
+        self.mean_x += delta_x * other.n / n
+        self.mean_y += delta_y * other.n / n
+        self.n = n
+        return self
+
+    def slope(self):
+        if self.n < 2 or self.sxx == 0:
+            return float('nan')
+        return float(self.sxy / self.sxx)
+
+    def intercept(self):
+        return float(self.mean_y - self.slope() * self.mean_x)
+
+    def to_tuple(self):
+        # Serialised form, RegressionAccumulator(*values) restores it
+        return int(self.n), float(self.mean_x), float(self.mean_y), float(self.sxx), float(self.sxy), float(self.syy)
+
+
+class ChannelSummary:
+    # Constant-state summary of one channel (fork or shock) fed in chunks: running max/min/mean, turning points and regressions
+    def __init__(self, acceptance=0.1, min_displacement=1):
+        self.min_displacement = min_displacement
+        self.tracker = TurningPointTracker(acceptance)
+        self.count = 0
+        self.maximum = -np.inf
+        self.minimum = np.inf
+        self.total = 0.0
+        self.lastTurn = None  # (index, value, is_peak) of the last turning point
+        # Regressions use speed in %/sample until the footer gives the sample time
+        self.compression = RegressionAccumulator()
+        self.rebound = RegressionAccumulator()
+
+    def update(self, y):
+        y = np.asarray(y, dtype=np.float64)
+        if len(y) == 0:
+            return
+        self.maximum = max(self.maximum, y.max())
+        self.minimum = min(self.minimum, y.min())
+        self.total += y.sum()
+        self.count += len(y)
+
+        peakIndexes, troughIndexes = self.tracker.update(y)
+        turns = np.concatenate((peakIndexes, troughIndexes))
+        isPeak = np.concatenate((np.ones(len(peakIndexes), dtype=bool), np.zeros(len(troughIndexes), dtype=bool)))
+        order = np.argsort(turns, kind="stable")
+        turns, isPeak = turns[order], isPeak[order]
+        values = self.tracker.values(turns)
+
+        if self.lastTurn is not None:
+            turns = np.concatenate(([self.lastTurn[0]], turns))
+            values = np.concatenate(([self.lastTurn[1]], values))
+            isPeak = np.concatenate(([self.lastTurn[2]], isPeak))
+        if len(turns):
+            self.lastTurn = (turns[-1], values[-1], isPeak[-1])
+
+        # Peaks and troughs alternate, so each consecutive pair is a compression (from a trough) or a rebound (from a peak)
+        displacement = np.abs(np.diff(values))
+        speed = displacement / np.diff(turns)
+        fromPeak = isPeak[:-1]
+        keep = displacement > self.min_displacement
+        self.compression.add(displacement[keep & ~fromPeak], speed[keep & ~fromPeak])
+        self.rebound.add(displacement[keep & fromPeak], speed[keep & fromPeak])
+
+    def fits(self, sample_time):
+        # Least squares (compression, rebound) SlopeFits with speed in %/s, NaN without a run time (no footer)
+        if sample_time <= 0:
+            return SlopeFit.empty("ols"), SlopeFit.empty("ols")
+        fits = []
+        for accumulator in (self.compression, self.rebound):
+            scaled = RegressionAccumulator(*accumulator.to_tuple())
+            scaled.mean_y /= sample_time
+            scaled.sxy /= sample_time
+            scaled.syy /= sample_time * sample_time
+            fits.append(ols_fit(scaled))
+        return fits
+
+    def finish(self, sample_time):
+        # Returns [max, min, mean, compression slope, rebound slope] as used by format_data
+        # Without samples everything is NaN, without a run time (no footer) the slopes are NaN
+        if self.count == 0:
+            return [float('nan')] * 5
+        compression, rebound = self.fits(sample_time)
+        return [self.maximum, self.minimum, self.total / self.count, compression.slope, rebound.slope]
+
+    def intervals(self, sample_time):
+        # [compression, rebound] slope confidence intervals as used by format_data
+        return [fit.interval() for fit in self.fits(sample_time)]
+
+
+def summarise_run_stream(stream, bike_data, min_displacement=1, chunk_lines=4096):
+    # Summary-only processing of a run read line by line (file or stdin). Memory does not grow with run length
+    # Returns the format_data text, run time (s) and sample count
+    stream = iter(stream)
+    schema = RunSchema.from_header(next(stream, None) or "")
+    next(stream, None)  # Skip initial values
+    shock = ChannelSummary(min_displacement=min_displacement)
+    fork = ChannelSummary(min_displacement=min_displacement)
+    timeOfRun = 0
+
+    while True:
+        lines = list(islice(stream, chunk_lines))
+        if not lines:
+            break
+        rows = [line for line in lines if ',' in line]
+        for line in lines:
+            if ',' not in line and line.strip() and line.strip() != 'Run finished':
+                timeOfRun = int(line) / 1000
+        shockRaw, forkRaw = parse_adc_rows(rows, schema=schema)
+        shock.update(normalise(shockRaw, bike_data[0], bike_data[1]))
+        fork.update(normalise(forkRaw, bike_data[2], bike_data[3]))
+
+    sample_time = timeOfRun / shock.count if shock.count else 0
+    text = format_data(shock.finish(sample_time), fork.finish(sample_time), shock.intervals(sample_time), fork.intervals(sample_time))
+    return text, timeOfRun, shock.count
+
+
+def format_data(shock, fork, shock_intervals=None, fork_intervals=None):
+    # Formats key variables in clean way for text output. Intervals ([compression, rebound] (low, high) pairs) follow the slopes
     text = "\n\t\t\tSHOCK:\t\tFORK:\n"
     names = ['Max:\t\t', 'Min:\t\t', 'Mean:\t\t', 'Comp:\t\t', 'Rebound:\t']
 
     for i in range(5):
         text += f"{names[i]}\t{round(shock[i], 2)}\t\t{round(fork[i], 2)}\n"
 
+    if shock_intervals is not None and fork_intervals is not None:
+        for name, (shockLow, shockHigh), (forkLow, forkHigh) in zip(['Comp 95%:\t', 'Rebound 95%:'], shock_intervals, fork_intervals):
+            text += f"{name}\t{round(shockLow, 2)}..{round(shockHigh, 2)}\t{round(forkLow, 2)}..{round(forkHigh, 2)}\n"
+
     text += f"\nCOMP DIFF:\t\t{round(fork[3] - shock[3], 2)}\nREBO DIFF:\t\t{round(fork[4] - shock[4], 2)}"
 
     return text
 
 
-def main(file_name):
-    result = process_accelerometer_file(file_name)
-    print(result["textData"])
+def main(file_name, bike_file):
+    result = process_accelerometer_file(file_name, process_bike_data(bike_file))
+    print(result.textData)
 
 
 if __name__ == "__main__":
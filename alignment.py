@@ -0,0 +1,74 @@
+# alignment.py
+# Time alignment of runs: each run starts when its logger was switched on, so the same trail features sit at different times
+# The lag comes from FFT cross-correlation of the travel (O(n log n)), differences are taken on a common time grid
+
+import numpy as np
+from instrumentation import instrumented
+
+MIN_OVERLAP = 0.5  # Lags leaving less than this fraction of the shorter run overlapping are not considered
+MAX_DIFFERENCE_POINTS = 20000  # Common grid size cap for difference traces, enough for a screen at any zoom of a short run
+
+
+def uniform_travel(run, channels, sample_time):
+    # Standardised travel of each channel resampled onto a uniform grid from t=0, one row per channel
+    grid = np.arange(0, run.timeOfRun, sample_time)
+    rows = np.empty((len(channels), len(grid)))
+    for row, channel in zip(rows, channels):
+        row[:] = np.interp(grid, run.xValues, run.channel(channel).values)
+        row -= row.mean()
+        std = row.std()
+        if std > 0:
+            row /= std
+    return rows
+
+
+def cross_correlation(a, b):
+    # Sum over rows of sum_t a[t + k] * b[t] for every lag k from -(len(b) - 1) to len(a) - 1, by zero-padded real FFTs
+    n = a.shape[1] + b.shape[1] - 1
+    size = 1 << (n - 1).bit_length()
+    spectrum = (np.fft.rfft(a, size, axis=1) * np.conj(np.fft.rfft(b, size, axis=1))).sum(axis=0)
+    circular = np.fft.irfft(spectrum, size)
+    return np.concatenate((circular[size - (b.shape[1] - 1):], circular[:a.shape[1]]))
+
+
+@instrumented("alignment", samples=lambda args, result: len(args[1].time))
+def find_offset(reference, run, channels=("fork", "shock")):
+    # Seconds to add to run's time axis so it lines up with reference, and the normalised correlation (about -1 to 1) there
+    sample_time = max(reference.timeOfRun / max(len(reference.time), 1), run.timeOfRun / max(len(run.time), 1))
+    if sample_time <= 0:
+        return 0.0, 0.0
+    a = uniform_travel(reference, channels, sample_time)
+    b = uniform_travel(run, channels, sample_time)
+    if a.shape[1] < 2 or b.shape[1] < 2:
+        return 0.0, 0.0
+
+    lags = np.arange(-(b.shape[1] - 1), a.shape[1])
+    overlap = np.minimum(a.shape[1], b.shape[1] + lags) - np.maximum(0, lags)
+    # Divided by the overlap so long lags with few samples compete fairly with short ones
+    score = np.where(overlap >= MIN_OVERLAP * min(a.shape[1], b.shape[1]),
+                     cross_correlation(a, b) / (np.maximum(overlap, 1) * len(channels)), -np.inf)
+    best = int(np.argmax(score))
+    return float(lags[best] * sample_time), float(score[best])
+
+
+def align_runs(runs, channels=("fork", "shock")):
+    # Offsets (s) for every run relative to the first, which stays at 0
+    return [0.0] + [find_offset(runs[0], run, channels)[0] for run in runs[1:]]
+
+
+def aligned_differences(runs, offsets, channel, max_points=MAX_DIFFERENCE_POINTS):
+    # Travel of each later run minus the first over their aligned overlap, all resampled in bulk onto one grid per pair
+    # Returns a (grid, difference) pair per later run, empty arrays when the runs do not overlap
+    reference = runs[0]
+    referenceTravel = reference.channel(channel).values
+    differences = []
+    for run, offset in zip(runs[1:], offsets[1:]):
+        start, end = max(0.0, offset), min(reference.timeOfRun, run.timeOfRun + offset)
+        if end <= start or len(run.time) < 2:
+            differences.append((np.zeros(0), np.zeros(0)))
+            continue
+        step = max(run.timeOfRun / len(run.time), (end - start) / max_points)
+        grid = np.arange(start, end, step)
+        difference = np.interp(grid, run.xValues + offset, run.channel(channel).values) - np.interp(grid, reference.xValues, referenceTravel)
+        differences.append((grid, difference))
+    return differences
@@ -0,0 +1,138 @@
+# batch_runner.py
+# Process every run in a directory against a bike profile and write a summary table (CSV or JSON)
+# Usage: python batch_runner.py run_data bike_profiles/wills_megatower.txt --output run_summary.csv
+
+from accelerometer_data_processor import process_accelerometer_file, process_bike_data
+from histograms import TravelHistogram, format_histograms, merge
+from run_format import run_files
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import argparse
+import csv
+import json
+import math
+import os
+import time
+
+SUMMARY_FIELDS = [
+    "file", "mtime", "size", "bike_values", "run_time", "samples",
+    "fork_max", "fork_min", "fork_mean", "shock_max", "shock_min", "shock_mean",
+    "fork_compression_slope", "fork_rebound_slope", "shock_compression_slope", "shock_rebound_slope",
+    "fork_bottom_outs", "shock_bottom_outs", "fork_histogram", "shock_histogram",
+]
+HISTOGRAM_FIELDS = ["fork_histogram", "shock_histogram"]  # Stored as JSON text in CSV summaries
+
+
+def summarise_run(file, bike_data):
+    # Processes one run into a flat summary row
+    data = process_accelerometer_file(file, bike_data)
+    stat = os.stat(file)
+    row = {
+        "file": file,
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "bike_values": " ".join(str(value) for value in bike_data),
+        "run_time": data.timeOfRun,
+        "samples": len(data.time),
+    }
+    for channel in ["fork", "shock"]:
+        result = data.channel(channel)
+        row[f"{channel}_max"] = float(result.maximum)
+        row[f"{channel}_min"] = float(result.minimum)
+        row[f"{channel}_mean"] = float(result.mean)
+        row[f"{channel}_compression_slope"] = result.compression.slope()
+        row[f"{channel}_rebound_slope"] = result.rebound.slope()
+        row[f"{channel}_bottom_outs"] = result.histogram.bottomOuts
+        row[f"{channel}_histogram"] = result.histogram.to_dict()
+    return row
+
+
+def find_runs(directory):
+    # Every run in the directory once (a converted run by its binary file), in a stable order
+    return sorted(run_files(os.path.join(directory, file) for file in os.listdir(directory)))
+
+
+def read_summary(output):
+    # Rows from a previous batch keyed by file, empty if there is none
+    if not os.path.exists(output):
+        return {}
+    with open(output, "r", newline="") as f:
+        if output.lower().endswith(".json"):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    return {row["file"]: row for row in rows}
+
+
+def json_safe(value):
+    # value with NaN and infinite floats (e.g. the slope of a run without rebounds) as None, written as JSON null
+    if isinstance(value, dict):
+        return {key: json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(item) for item in value]
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def write_summary(output, rows):
+    with open(output, "w", newline="") as f:
+        if output.lower().endswith(".json"):
+            json.dump(json_safe(rows), f, indent=2, allow_nan=False)
+        else:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+            writer.writeheader()
+            writer.writerows({**row, **{field: json.dumps(row[field], separators=(",", ":")) if isinstance(row[field], dict) else row[field]
+                                        for field in HISTOGRAM_FIELDS}} for row in rows)
+
+
+def is_unchanged(row, file, bike_data):
+    # A previous row can be reused when the run file and the calibration are the same
+    if row is None or not all(row.get(field) for field in HISTOGRAM_FIELDS):  # Summaries from before histograms
+        return False
+    stat = os.stat(file)
+    return (float(row["mtime"]) == stat.st_mtime and int(row["size"]) == stat.st_size
+            and row["bike_values"] == " ".join(str(value) for value in bike_data))
+
+
+def aggregate(rows, channel):
+    # One histogram for every run in the summary, merged without reprocessing any raw data
+    return merge(TravelHistogram.from_dict(row[f"{channel}_histogram"]) for row in rows)
+
+
+def run_batch(directory, bike_file, output, workers=None):
+    # Processes changed runs across all cores, returns (rows, number processed, samples per second)
+    bike_data = process_bike_data(bike_file)
+    previous = read_summary(output)
+    files = find_runs(directory)
+    changed = [file for file in files if not is_unchanged(previous.get(file), file, bike_data)]
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        processed = {row["file"]: row for row in executor.map(summarise_run, changed, repeat(bike_data))}
+    elapsed = time.perf_counter() - start
+
+    rows = [processed.get(file, previous.get(file)) for file in files]
+    write_summary(output, rows)
+    samples = sum(row["samples"] for row in processed.values())
+    return rows, len(changed), samples / elapsed if elapsed > 0 else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process every run in a directory into a summary table")
+    parser.add_argument("directory", help="Folder of run files, e.g. run_data")
+    parser.add_argument("bike_file", help="Bike profile, e.g. bike_profiles/wills_megatower.txt")
+    parser.add_argument("--output", default="run_summary.csv", help="Summary file, .csv or .json")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    rows, processed, throughput = run_batch(args.directory, args.bike_file, args.output, args.workers)
+    print(f"{processed} of {len(rows)} runs processed ({len(rows) - processed} unchanged) -> {args.output}")
+    if processed:
+        print(f"Throughput: {throughput:,.0f} samples/s")
+    if rows:
+        print(f"All runs:{format_histograms(aggregate(rows, 'shock'), aggregate(rows, 'fork'))}")
+
+
+if __name__ == "__main__":
+    main()
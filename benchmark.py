@@ -0,0 +1,171 @@
+# benchmark.py
+# Times each processing stage on every run in run_data/ (and optional synthetic long runs), reporting samples/s and peak memory
+# Usage: python benchmark.py --output benchmark_results.json [--baseline old.json] [--synthetic 10 100]
+
+from accelerometer_data_processor import (read_run_file, normalise, turning_points, find_displacement_speed,
+                                          linear_regression, process_accelerometer_file, process_bike_data)
+from spectral import run_spectra, sample_rate
+from run_schema import TimeAxis
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+RUN_FOLDER = "run_data"
+BIKE_FILE = "bike_profiles/wills_megatower.txt"
+HEADER = "RS:1000:rear_sus,FS:1000:front_sus,RB:250:test2,FB:250:test3"
+SYNTHETIC_BASE_SAMPLES = 14555  # RUN7 length, synthetic runs are multiples of it
+SYNTHETIC_SAMPLE_RATE = 235  # Rows per second actually logged
+REGRESSION_TOLERANCE = 1.2  # A stage more than 20% slower than the baseline is a regression
+
+
+def generate_synthetic_run(path, samples, seed=0):
+    # Writes a run in the logger format (header, initial values, 10 columns, run time, "Run finished")
+    # Travel is sag plus decaying oscillations from random impacts, IMU channels follow the impacts
+    rng = np.random.default_rng(seed)
+    t = np.arange(samples) / SYNTHETIC_SAMPLE_RATE
+    impulses = np.zeros(samples)
+    hits = rng.integers(0, samples, max(samples // 40, 1))
+    impulses[hits] = rng.exponential(60, len(hits))
+    response_t = np.arange(int(1.5 * SYNTHETIC_SAMPLE_RATE)) / SYNTHETIC_SAMPLE_RATE
+    response = np.exp(-4 * response_t) * np.cos(2 * np.pi * 2.5 * response_t)
+    bumps = np.convolve(impulses, response)[:samples]
+
+    shock = np.clip(650 + bumps + rng.normal(0, 1.5, samples), 0, 1023).round()
+    fork = np.clip(600 + 0.8 * np.roll(bumps, -12) + rng.normal(0, 1.5, samples), 0, 1023).round()
+    accel = rng.normal(0, 1.0, (samples, 3)) + np.outer(np.gradient(bumps), [0.2, 1.0, 0.5]) + [0, -9.81, 0]
+    gyro = rng.normal(0, 0.1, (samples, 3))
+    rows = np.column_stack((accel, gyro, shock, fork, np.zeros(samples), np.zeros(samples)))
+
+    with open(path, "w", newline="") as f:
+        f.write(HEADER + "\n")
+        f.write(f"{int(shock[0])},{int(fork[0])}\n")
+        np.savetxt(f, rows, fmt=["%.2f"] * 6 + ["%d", "%d", "%.1f", "%.1f"], delimiter=",")
+        f.write(f"{int(t[-1] * 1000 + 1000 / SYNTHETIC_SAMPLE_RATE)}\nRun finished\n")
+    return path
+
+
+def measure(stage, repeats):
+    # Best wall time over repeats and peak traced memory of one call
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = stage()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    stage()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak, result
+
+
+def benchmark_run(file, bike_data, repeats, figures=True):
+    # Returns {stage: {seconds, samples_per_s, peak_kib}} for one run
+    stages = {}
+
+    def record(name, stage):
+        seconds, peak, result = measure(stage, repeats)
+        stages[name] = {"seconds": seconds, "peak_kib": peak / 1024}
+        return result
+
+    header, initialValues, shockRaw, forkRaw, timeOfRun, accel, channels = record("parse", lambda: read_run_file(file))
+    samples = len(shockRaw)
+    x = TimeAxis.for_run(samples, timeOfRun)
+    shock, fork = record("normalise", lambda: (normalise(shockRaw, bike_data[0], bike_data[1]),
+                                               normalise(forkRaw, bike_data[2], bike_data[3])))
+    turns = record("turning_points", lambda: [turning_points(y, 0.1) for y in (shock, fork)])
+
+    def pair():
+        pairs = []
+        for y, (peaks, troughs) in zip((shock, fork), turns):
+            pairs.append(find_displacement_speed(y[troughs], y[peaks], x[troughs], x[peaks]))
+            pairs.append(find_displacement_speed(y[peaks], y[troughs], x[peaks], x[troughs]))
+        return pairs
+    pairs = record("find_displacement_speed", pair)
+    record("linear_regression", lambda: [linear_regression(displacement, speed) for _, speed, displacement in pairs])
+    record("spectrum", lambda: run_spectra(fork, shock, accel, sample_rate(samples, timeOfRun, header)))
+
+    if figures:
+        data = process_accelerometer_file(file, bike_data)
+        record("figures", lambda: build_figures(data, file))
+
+    for stage in stages.values():
+        stage["samples_per_s"] = samples / stage["seconds"] if stage["seconds"] > 0 else float("inf")
+    return {"samples": samples, "stages": stages}
+
+
+def build_figures(data, file):
+    # Builds and fills the single-run dashboard figures, outside of a server document
+    import dashboard_figures as figures  # Imported here, the Bokeh import is only paid when figures are timed
+    from downsampling import LevelOfDetail
+    sources = figures.create_sources()
+    displacement_graph = figures.create_displacement_plot(sources["displacement"])
+    comp_graph = figures.create_compression_plot(sources["Compression"])
+    reb_graph = figures.create_rebound_plot(sources["Rebound"])
+    psd_graph = figures.create_spectrum_plot(sources["Spectrum"])
+    transfer_graph = figures.create_transfer_plot(sources["Spectrum"])
+    lod = LevelOfDetail(data.xValues, [data.fork.values, data.shock.values])
+    figures.update_displacement_plot(displacement_graph, sources["displacement"], data, lod, file, BIKE_FILE)
+    figures.update_regression_plot(comp_graph, sources["Compression"], data, "Compression", file)
+    figures.update_regression_plot(reb_graph, sources["Rebound"], data, "Rebound", file)
+    figures.update_spectrum_plots(psd_graph, transfer_graph, sources["Spectrum"], data, file)
+    return displacement_graph, comp_graph, reb_graph, psd_graph, transfer_graph
+
+
+def compare_to_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    # Lists (run, stage, slowdown) for stages slower than the baseline by more than the tolerance ratio
+    regressions = []
+    for run, result in results["runs"].items():
+        old = baseline.get("runs", {}).get(run)
+        if old is None:
+            continue
+        for name, stage in result["stages"].items():
+            old_stage = old["stages"].get(name)
+            if old_stage and stage["seconds"] > old_stage["seconds"] * tolerance:
+                regressions.append((run, name, stage["seconds"] / old_stage["seconds"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage processing benchmark over the run corpus")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file for the results")
+    parser.add_argument("--baseline", help="Earlier results to compare against, exits non-zero on regressions")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE, help="Slowdown ratio counted as a regression")
+    parser.add_argument("--synthetic", type=int, nargs="*", default=[], help="Also time synthetic runs this many times RUN7's length")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--no-figures", action="store_true", help="Skip the Bokeh figure construction stage")
+    args = parser.parse_args()
+
+    bike_data = process_bike_data(BIKE_FILE)
+    files = sorted(os.path.join(RUN_FOLDER, file) for file in os.listdir(RUN_FOLDER)
+                   if file.lower().endswith(".txt") and not file.startswith("uploaded"))
+    results = {"bike_file": BIKE_FILE, "repeats": args.repeats, "runs": {}}
+    with tempfile.TemporaryDirectory(prefix="sdsquared_bench_") as synthetic_dir:  # Synthetic runs are removed afterwards
+        for scale in args.synthetic:
+            files.append(generate_synthetic_run(os.path.join(synthetic_dir, f"synthetic_x{scale}.txt"), SYNTHETIC_BASE_SAMPLES * scale))
+
+        for file in files:
+            run = os.path.basename(file)
+            results["runs"][run] = benchmark_run(file, bike_data, args.repeats, figures=not args.no_figures)
+            stages = results["runs"][run]["stages"]
+            print(f"{run:<22} {results['runs'][run]['samples']:>9} samples  " +
+                  "  ".join(f"{name} {stage['samples_per_s'] / 1e6:.1f}M/s {stage['peak_kib']:.0f}KiB" for name, stage in stages.items()))
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        for run, name, slowdown in regressions:
+            print(f"REGRESSION {run} {name}: {slowdown:.2f}x slower than baseline")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
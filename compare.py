@@ -1,30 +1,51 @@
 # compare.py
-# Compare fork and shock values from 2 runs in accelerometer reading graph and compression/rebound scatter plots
+# Compare fork and shock values from any number of runs in accelerometer reading graph and compression/rebound scatter plots
 
 from bokeh.io import curdoc
 from bokeh.plotting import figure
-from bokeh.models import Range1d, Div, TextInput, FileInput, Dropdown, Paragraph
+from bokeh.models import Range1d, Div, TextInput, FileInput, Dropdown, Paragraph, ColumnDataSource, MultiChoice, Toggle
+from bokeh.core.property.vectorization import value
+from bokeh.events import RangesUpdate
 from bokeh.layouts import grid, row, column
-from accelerometer_data_processor import process_accelerometer_file
+from bokeh.palettes import Category10
+from accelerometer_data_processor import process_bike_data
+from run_cache import run_cache
+from downsampling import LevelOfDetail
+from instrumentation import instrumented
+from workers import run_in_background
+from run_format import RUN_EXTENSIONS
+from run_catalog import RunCatalog, run_label
+from alignment import align_runs, aligned_differences
+from functools import partial
 import base64
 import os
+import numpy as np
 
 # Default files
-current_file1 = "run_data/testrun1.txt"
-current_file2 = "run_data/testrun2.txt"
+# bokeh serve runs this script once per session, so these globals and the document below belong to one session
+# Only run_cache, the worker pool and the run catalog file are shared between sessions
+current_files = ["run_data/testrun1.txt", "run_data/testrun2.txt"]
 current_bike_file = "bike_profiles/wills_megatower.txt"
+request_count = 0  # Latest selection, older results arriving late are ignored
+document = curdoc()
+
+RUN_COLOURS = Category10[10]  # Line colour per run, reused after ten runs
+PREALLOCATED_RUNS = 10  # Run slots built before the document is shown, adding glyphs to a live document is slow
+CATALOG_REFRESH_MS = 30000  # How often the run folder is checked for new or changed files
 
 # Load and process data
-def load_and_process_data(file_path, bike_data):
-    # Load and process accelerometer data from a file
-    data = process_accelerometer_file(file_path, bike_data)
-    return data
+def load_and_process_data(file_paths, bike_data, regression="ols"):
+    # Load and process accelerometer data from every file or upload of this session, cached runs are reused and the rest processed in parallel
+    paths = [path for path in file_paths if path not in uploads]
+    results = dict(zip(paths, run_cache.results_for(paths, bike_data, regression=regression)))
+    return [run_cache.upload_result(*uploads[path], bike_data, regression=regression) if path in uploads else results[path] for path in file_paths]
 
 # Displacement plot - Uses accelerometer readings to make displacement graph
-def decomposed_displacement_plot(vals):
-    # Plot 2 accelerometer recordings on a graph
+@instrumented("figure")
+def decomposed_displacement_plot():
+    # Empty graph for any number of accelerometer recordings, runs are added by add_displacement_run
     displacement_graph = figure(
-        title=vals["title"],
+        title="Displacement Plot",
         sizing_mode="stretch_width",
         height=450,
         x_axis_label="Time (s)",
@@ -32,76 +53,94 @@ def decomposed_displacement_plot(vals):
         tools="pan, reset, wheel_zoom, xwheel_zoom, fullscreen, examine, crosshair",
     )
 
-    displacement_graph.x_range = Range1d(start=0, end=vals["timeOfRun"], bounds=(0, vals["timeOfRun"]))
+    displacement_graph.x_range = Range1d(start=0, end=1, bounds=(0, 1))
     displacement_graph.y_range = Range1d(start=0, end=100, bounds=(0, 100))
 
-    displacement_graph.line(vals["x_val1"], vals["y_val1"], legend_label=vals["name1"], color="#00FFFF", line_width=0.5)
-    displacement_graph.scatter(vals["peak_times1"], vals["fork_peaks1"], color="red", size=2, legend_label=vals["peaksName1"], marker="circle")
-    displacement_graph.scatter(vals["trough_times1"], vals["fork_troughs1"], color="orange", size=2, legend_label=vals["troughsName1"], marker="circle")
+    return displacement_graph
 
-    displacement_graph.line(vals["x_val2"], vals["y_val2"], legend_label=vals["name2"], color="#FF0000", line_width=0.5)
-    displacement_graph.scatter(vals["peak_times2"], vals["fork_peaks2"], color="red", size=2, legend_label=vals["peaksName2"], marker="circle")
-    displacement_graph.scatter(vals["trough_times2"], vals["fork_troughs2"], color="orange", size=2, legend_label=vals["troughsName2"], marker="circle")
+def add_displacement_run(graph):
+    # Adds line, peak and trough glyphs for one more run, backed by persistent sources
+    run = len(graph.renderers) // 3
+    slot = {name: ColumnDataSource(data=dict(x=[], y=[])) for name in ["line", "peaks", "troughs"]}
+    slot["renderers"] = [
+        graph.line("x", "y", source=slot["line"], legend_label=f"run {run + 1}", color=RUN_COLOURS[run % 10], line_width=0.5),
+        graph.scatter("x", "y", source=slot["peaks"], color="red", size=2, legend_label=f"run {run + 1} peaks", marker="circle"),
+        graph.scatter("x", "y", source=slot["troughs"], color="orange", size=2, legend_label=f"run {run + 1} troughs", marker="circle"),
+    ]
+    graph.legend.click_policy = "hide"
+    return slot
+
+@instrumented("figure update", samples=lambda args, result: sum(len(data.time) for data in args[2]))
+def update_displacement_plot(graph, slots, runs, lods, channel, file_names, offsets=None):
+    # Replace every run's recording, the range, title and legend labels in place, drawing each run from its level of detail
+    # offsets (s) shift each run's time axis, e.g. from alignment.align_runs
+    while len(slots) < len(runs):
+        slots.append(add_displacement_run(graph))
+    offsets = offsets or [0.0] * len(runs)
+
+    for slot, data, file_name, offset in zip(slots, runs, file_names, offsets):
+        result = data.channel(channel)
+        slot["peaks"].data = dict(x=result.peakTimes + offset, y=result.peaks)
+        slot["troughs"].data = dict(x=result.troughTimes + offset, y=result.troughs)
+        shift = f" ({offset:+.1f} s)" if offset else ""
+        labels = [f"{channel}: {file_name}{shift}", f"{channel} peaks: {file_name}", f"{channel} troughs: {file_name}"]
+        for renderer, label in zip(slot["renderers"], labels):
+            legend_item(graph, renderer).label = value(label)
+    update_displacement_lines(slots, lods)
+    show_slots(graph, slots, len(runs))
+
+    start = min(offsets)
+    end = max(data.timeOfRun + offset for data, offset in zip(runs, offsets))
+    graph.title.text = f"{channel.capitalize()} Displacement Plot: {' VS '.join(file_names)}"
+    graph.x_range.update(start=start, end=end, bounds=(start, end))
+
+# Difference plot - aligned travel of each run minus the first run
+@instrumented("figure")
+def decomposed_difference_plot(x_range):
+    # Graph sharing the displacement plot's time range, every difference trace is one entry of a single multi-line glyph
+    graph = figure(
+        title="Aligned Difference",
+        sizing_mode="stretch_width",
+        height=300,
+        x_axis_label="Time (s)",
+        y_axis_label="Difference in displacement (%)",
+        tools="pan, reset, wheel_zoom, xwheel_zoom, fullscreen, examine, crosshair",
+        x_range=x_range,
+    )
+    source = ColumnDataSource(data=dict(xs=[], ys=[], color=[], label=[]))
+    graph.multi_line("xs", "ys", source=source, line_color="color", legend_field="label", line_width=0.5)
+    graph.toolbar.logo = None
+    return graph, source
+
+def update_difference_plot(graph, source, differences, channel, file_names):
+    # Replace the difference traces of every later run against the first
+    source.data = dict(
+        xs=[times for times, _ in differences],
+        ys=[difference for _, difference in differences],
+        color=[RUN_COLOURS[(run + 1) % 10] for run in range(len(differences))],
+        label=[f"{file_name} - {file_names[0]}" for file_name in file_names[1:]],
+    )
+    graph.title.text = f"{channel.capitalize()} Aligned Difference: {' VS '.join(file_names)}"
 
-    return displacement_graph
+def update_displacement_lines(slots, lods, x0=None, x1=None):
+    # Send only the decimated samples of each run for the visible window
+    for slot, lod in zip(slots, lods):
+        indexes = lod.window(x0, x1)
+        slot["line"].data = dict(x=lod.x[indexes], y=lod.channels[0][indexes])
 
-# Fork displacement values
-def fork_displacement_values(data1, data2, file1_name, file2_name):
-    fork_values = {
-        "title": f"Fork Displacement Plot: {file1_name} VS {file2_name}",
-        "timeOfRun": max(data1["timeOfRun"], data2["timeOfRun"]),
-        "x_val1": data1["xValues"],
-        "y_val1": data1["yForkValues"],
-        "name1": f"fork1: {file1_name}",
-        "peak_times1": data1["forkPeakTimes"],
-        "fork_peaks1": data1["forkPeaks"],
-        "peaksName1": f"fork1 peaks: {file1_name}",
-        "trough_times1": data1["forkTroughTimes"],
-        "fork_troughs1": data1["forkTroughs"],
-        "troughsName1": f"fork1 troughs: {file1_name}",
-        "x_val2": data2["xValues"],
-        "y_val2": data2["yForkValues"],
-        "name2": f"fork2: {file2_name}",
-        "peak_times2": data2["forkPeakTimes"],
-        "fork_peaks2": data2["forkPeaks"],
-        "peaksName2": f"fork2 peaks: {file2_name}",
-        "trough_times2": data2["forkTroughTimes"],
-        "fork_troughs2": data2["forkTroughs"],
-        "troughsName2": f"fork2 troughs: {file2_name}",
-    }
-    return fork_values
-
-# Shock displacement values
-def shock_displacement_values(data1, data2, file1_name, file2_name):
-    shock_values = {
-        "title": f"Shock Displacement Plot: {file1_name} VS {file2_name}",
-        "timeOfRun": max(data1["timeOfRun"], data2["timeOfRun"]),
-        "x_val1": data1["xValues"],
-        "y_val1": data1["yShockValues"],
-        "name1": f"shock1: {file1_name}",
-        "peak_times1": data1["shockPeakTimes"],
-        "fork_peaks1": data1["shockPeaks"],
-        "peaksName1": f"shock1 peaks: {file1_name}",
-        "trough_times1": data1["shockTroughTimes"],
-        "fork_troughs1": data1["shockTroughs"],
-        "troughsName1": f"shock1 troughs: {file1_name}",
-        "x_val2": data2["xValues"],
-        "y_val2": data2["yShockValues"],
-        "name2": f"shock2: {file2_name}",
-        "peak_times2": data2["shockPeakTimes"],
-        "fork_peaks2": data2["shockPeaks"],
-        "peaksName2": f"shock2 peaks: {file2_name}",
-        "trough_times2": data2["shockTroughTimes"],
-        "fork_troughs2": data2["shockTroughs"],
-        "troughsName2": f"shock2 troughs: {file2_name}",
-    }
-    return shock_values
+def displacement_range_changed(graph, slots):
+    # Re-request a finer (or coarser) slice of every run after zoom or pan
+    def callback(event):
+        if graph in displacement_lods:
+            update_displacement_lines(slots, displacement_lods[graph], event.x0, event.x1)
+    return callback
 
 # Regression plot - Uses values to make scatter plot with regression lines
-def decomposed_regression_plot(vals):
-    # Scatter plot of compression/rebound values with regression lines
+@instrumented("figure")
+def decomposed_regression_plot(kind):
+    # Scatter plot of compression/rebound values with regression lines, runs are added by add_regression_run
     graph = figure(
-        title=vals["title"],
+        title=f"{kind} Scatter Plot",
         sizing_mode="stretch_width",
         height=450,
         x_axis_label="Speed of displacement (%/s)",
@@ -109,162 +148,136 @@ def decomposed_regression_plot(vals):
         tools="pan, reset, wheel_zoom, xwheel_zoom, fullscreen, examine, crosshair",
     )
 
-    speed1 = vals["speed1"]; speedR1 = sorted(speed1)[int(len(speed1)*0.9)]
-    displacement1 = vals["displacement1"]
-    regress1 = vals["regress1"]
-    speed2 = vals["speed2"]; speedR2 = sorted(speed2)[int(len(speed2)*0.9)]
-    displacement2 = vals["displacement2"]
-    regress2 = vals["regress2"]
-
-    graph.x_range = Range1d(start=0, end=max(speedR1, speedR2) * 1.1)
-    graph.y_range = Range1d(start=0, end=max(max(displacement1), max(displacement2)) * 1.1)
-
-    graph.scatter(speed1, displacement1, color="blue", size=4, legend_label=vals["name1"], marker="circle")
-    graph.line(x=regress1, y=displacement1, color="#00FFFF", legend_label=f"{vals['name1']} Regression", line_width=2)
-
-    graph.scatter(speed2, displacement2, color="orange", size=4, legend_label=vals["name2"], marker="circle")
-    graph.line(x=regress2, y=displacement2, color="red", legend_label=f"{vals['name2']} Regression", line_width=2)
-
-    mean_x = [(min(regress1) + min(regress2)) / 2, (max(regress1) + max(regress2)) / 2]
-    mean_y = [(min(displacement1) + min(displacement2)) / 2, (max(displacement1) + max(displacement2)) / 2]
-
-    graph.line(x=mean_x, y=mean_y, color="white", legend_label="Mean Compression Regression", line_width=2)
-
-    return graph
-
-# Fork compression values
-def fork_compression_values(data1, data2, file1_name, file2_name):
-    fork_values = {
-        "title": f"Fork Compression Scatter Plot: {file1_name} VS {file2_name}",
-        "speed1": data1["forkCompressionSpeed"],
-        "displacement1": data1["forkCompressionDisplacement"],
-        "regress1": data1["forkCompression_regress"],
-        "name1": "fork1: " + file1_name,
-        "speed2": data2["forkCompressionSpeed"],
-        "displacement2": data2["forkCompressionDisplacement"],
-        "regress2": data2["forkCompression_regress"],
-        "name2": "fork2: " + file2_name,
-    }
-    return fork_values
-
-# Fork rebound values
-def fork_rebound_values(data1, data2, file1_name, file2_name):
-    fork_values = {
-        "title": f"Fork Rebound Scatter Plot: {file1_name} VS {file2_name}",
-        "speed1": data1["forkReboundSpeed"],
-        "displacement1": data1["forkReboundDisplacement"],
-        "regress1": data1["forkRebound_regress"],
-        "name1": "fork1: " + file1_name,
-        "speed2": data2["forkReboundSpeed"],
-        "displacement2": data2["forkReboundDisplacement"],
-        "regress2": data2["forkRebound_regress"],
-        "name2": "fork2: " + file2_name,
-    }
-    return fork_values
-
-# Shock compression values
-def shock_compression_values(data1, data2, file1_name, file2_name):
-    shock_values = {
-        "title": f"Shock Compression Scatter Plot: {file1_name} VS {file2_name}",
-        "speed1": data1["shockCompressionSpeed"],
-        "displacement1": data1["shockCompressionDisplacement"],
-        "regress1": data1["shockCompression_regress"],
-        "name1": "shock1: " + file1_name,
-        "speed2": data2["shockCompressionSpeed"],
-        "displacement2": data2["shockCompressionDisplacement"],
-        "regress2": data2["shockCompression_regress"],
-        "name2": "shock2: " + file2_name,
-    }
-    return shock_values
-
-# Shock rebound values
-def shock_rebound_values(data1, data2, file1_name, file2_name):
-    shock_values = {
-        "title": f"Shock Rebound Scatter Plot: {file1_name} VS {file2_name}",
-        "speed1": data1["shockReboundSpeed"],
-        "displacement1": data1["shockReboundDisplacement"],
-        "regress1": data1["shockRebound_regress"],
-        "name1": "shock1: " + file1_name,
-        "speed2": data2["shockReboundSpeed"],
-        "displacement2": data2["shockReboundDisplacement"],
-        "regress2": data2["shockRebound_regress"],
-        "name2": "shock2: " + file2_name,
-    }
-    return shock_values
+    graph.x_range = Range1d(start=0, end=1)
+    graph.y_range = Range1d(start=0, end=1)
+
+    mean_source = ColumnDataSource(data=dict(x=[], y=[]))
+    graph.line("x", "y", source=mean_source, color="white", legend_label=f"Mean {kind} Regression", line_width=2)
+    graph.legend.click_policy = "hide"
+
+    return graph, mean_source
+
+def add_regression_run(graph):
+    # Adds scatter and regression line glyphs for one more run, backed by a persistent source
+    run = (len(graph.renderers) - 1) // 2
+    slot = {"points": ColumnDataSource(data=dict(speed=[], displacement=[], regress=[]))}
+    slot["renderers"] = [
+        graph.scatter("speed", "displacement", source=slot["points"], color=RUN_COLOURS[run % 10], size=4, legend_label=f"run {run + 1}", marker="circle"),
+        graph.line("regress", "displacement", source=slot["points"], color=RUN_COLOURS[run % 10], legend_label=f"run {run + 1} Regression", line_width=2),
+    ]
+    graph.legend.click_policy = "hide"
+    return slot
+
+@instrumented("figure update")
+def update_regression_plot(graph, slots, mean_source, runs, channel, kind, file_names):
+    # Replace every run's scatter and regression data, ranges, title and legend labels in place
+    while len(slots) < len(runs):
+        slots.append(add_regression_run(graph))
+
+    speeds, displacements, regressions = [], [], []
+    for slot, data, file_name in zip(slots, runs, file_names):
+        result = data.channel(channel)
+        speed = getattr(result, kind.lower() + "Speed")
+        displacement = getattr(result, kind.lower() + "Displacement")
+        regress = getattr(result, kind.lower() + "Regress")
+        slot["points"].data = dict(speed=speed, displacement=displacement, regress=regress)
+        if len(speed):  # Runs without any compression/rebound are left out of the ranges
+            speeds.append(np.sort(speed)[int(len(speed)*0.9)])
+            displacements.append(displacement)
+            regressions.append(regress)
+        labels = [f"{channel}: {file_name}", f"{channel}: {file_name} Regression"]
+        for renderer, label in zip(slot["renderers"], labels):
+            legend_item(graph, renderer).label = value(label)
+    show_slots(graph, slots, len(runs))
+
+    if regressions:
+        mean_x = [np.mean([np.min(r) for r in regressions]), np.mean([np.max(r) for r in regressions])]
+        mean_y = [np.mean([np.min(d) for d in displacements]), np.mean([np.max(d) for d in displacements])]
+    else:
+        mean_x, mean_y = [], []
+    mean_source.data = dict(x=mean_x, y=mean_y)
 
+    graph.title.text = f"{channel.capitalize()} {kind} Scatter Plot: {' VS '.join(file_names)}"
+    graph.x_range.update(start=0, end=max(speeds, default=1) * 1.1)
+    graph.y_range.update(start=0, end=max((np.max(d) for d in displacements), default=1) * 1.1)
 
-# Main function
-def main(text_file1, text_file2, bike_file):
-    from dashboard import process_bike_data
-    global current_file1, current_file2
-    current_file1 = text_file1
-    current_file2 = text_file2
-    curdoc().clear()
+def legend_item(graph, renderer):
+    # Legend entry drawn for a glyph renderer
+    return next(item for item in graph.legend.items if renderer in item.renderers)
 
-    bike_data = process_bike_data(bike_file)
+def show_slots(graph, slots, count):
+    # Hides glyphs and legend entries of run slots beyond the current selection
+    for i, slot in enumerate(slots):
+        for renderer in slot["renderers"]:
+            renderer.visible = i < count
+            legend_item(graph, renderer).visible = i < count
 
-    # Load and process data for both files
-    data1 = load_and_process_data(text_file1, bike_data)
-    data2 = load_and_process_data(text_file2, bike_data)
-
-    if data1 is not None and data2 is not None:
-        # Create fork plots
-        fork_displacement_graph = decomposed_displacement_plot(fork_displacement_values(data1, data2, text_file1, text_file2))
-        fork_comp_graph = decomposed_regression_plot(fork_compression_values(data1, data2, text_file1, text_file2))
-        fork_reb_graph = decomposed_regression_plot(fork_rebound_values(data1, data2, text_file1, text_file2))
-
-        # Create shock plots
-        shock_displacement_graph = decomposed_displacement_plot(shock_displacement_values(data1, data2, text_file1, text_file2))
-        shock_comp_graph = decomposed_regression_plot(shock_compression_values(data1, data2, text_file1, text_file2))
-        shock_reb_graph = decomposed_regression_plot(shock_rebound_values(data1, data2, text_file1, text_file2))
-
-        # Configure graphs
-        for graph in [fork_displacement_graph, fork_comp_graph, fork_reb_graph, shock_displacement_graph,
-                      shock_comp_graph, shock_reb_graph]:
-            graph.toolbar.logo = None
-            graph.legend.click_policy = "hide"
-
-        # Create headers and subheadings
-        head = Div(text="<h1 style='font-size:40px;'>Comparison of Accelerometer Data</h1>")
-        fork_subheading = Div(text="<h2 style='font-size:30px;'>Fork Values</h2>")
-        shock_subheading = Div(text="<h2 style='font-size:30px;'>Shock Values</h2>")
-        displacement_subsubheading1 = Div(text="<h3 style='font-size:25px;'>Displacement Plot</h3>")
-        regression_subsubheading1 = Div(text="<h3 style='font-size:25px;'>Regression Lines</h3>")
-        displacement_subsubheading2 = Div(text="<h3 style='font-size:25px;'>Displacement Plot</h3>")
-        regression_subsubheading2 = Div(text="<h3 style='font-size:25px;'>Regression Lines</h3>")
-
-        # Create dashboard layout
-        dashboard_layout = column(
-            head,
-            top_select_layout,
-            fork_subheading,
-            displacement_subsubheading1,
-            fork_displacement_graph,
-            regression_subsubheading1,
-            row(fork_comp_graph, fork_reb_graph, sizing_mode='stretch_width'),
-            shock_subheading,
-            displacement_subsubheading2,
-            shock_displacement_graph,
-            regression_subsubheading2,
-            row(shock_comp_graph, shock_reb_graph, sizing_mode='stretch_width'),
-            sizing_mode="stretch_both"
-        )
-
-        layout = column(dashboard_layout, sizing_mode="stretch_both")
-    else:
-        layout = column(top_select_layout, sizing_mode="stretch_both")
 
-    # Set theme and display
-    curdoc().theme = "dark_minimal"
-    curdoc().clear()
-    curdoc().add_root(layout)
+def load_runs(file_paths, bike_file, align=False, differences=False):
+    # Worker side of main: everything heavy, nothing that touches the document. Catalogued runs get their summaries recorded
+    # Returns the runs, their time offsets, each channel's levels of detail and, if asked for, the aligned difference traces per channel
+    bike_data = process_bike_data(bike_file)
+    runs = load_and_process_data(file_paths, bike_data)
+    for path, data in zip(file_paths, runs):
+        if data is not None and path not in uploads:
+            catalog.record_summary(path, bike_file, bike_data, data)
+    if any(data is None for data in runs) or not runs:
+        return runs, None, None, None
+    offsets = align_runs(runs) if align else [0.0] * len(runs)
+    x_values = [data.xValues + offset for data, offset in zip(runs, offsets)]  # Shared by both channels' levels of detail
+    lods = {channel: [LevelOfDetail(x, [data.channel(channel).values]) for data, x in zip(runs, x_values)] for channel in ["fork", "shock"]}
+    traces = {channel: aligned_differences(runs, offsets, channel) for channel in ["fork", "shock"]} if differences else None
+    return runs, offsets, lods, traces
 
-# File selection dropdowns
+# Main function
+def main(text_files, bike_file):
+    # Queue the selected runs on the worker pool, show_runs updates the document when they are ready
+    global current_files, current_bike_file, request_count
+    current_files = list(text_files)
+    current_bike_file = bike_file
+    request_count += 1
+    align, differences = align_toggle.active, difference_toggle.active
+    key = ("runs", tuple(uploads[path][0] if path in uploads else path for path in current_files), bike_file, align, differences)  # Uploads are identified by content across sessions
+    loading_div.visible = True
+    run_in_background(document, key, load_runs, (current_files, bike_file, align, differences), partial(show_runs, request_count))
+
+def show_runs(request, future):
+    # Runs on the event loop once the worker is done. Results of a superseded selection are dropped
+    if request != request_count:
+        return
+    loading_div.visible = False
+    runs, offsets, lods, differences = future.result()
+    loaded = len(runs) > 0 and all(data is not None for data in runs)
+
+    if loaded:
+        for channel, graphs in plots.items():
+            displacement_lods[graphs["displacement"]] = lods[channel]
+            update_displacement_plot(graphs["displacement"], graphs["displacement_slots"], runs, lods[channel], channel, current_files, offsets)
+            graphs["difference"].visible = differences is not None
+            if differences is not None:
+                update_difference_plot(graphs["difference"], graphs["difference_source"], differences[channel], channel, current_files)
+            for kind in ["Compression", "Rebound"]:
+                update_regression_plot(graphs[kind], graphs[kind + "_slots"], graphs[kind + "_mean"], runs, channel, kind, current_files)
+
+    dashboard_layout.visible = loaded
+
+# File selection
 folder_path = "run_data"
-if os.path.exists(folder_path):  # Check if folder exists
-    txt_files = [(file, file) for file in os.listdir(folder_path) if file.lower().endswith(".txt")]
-else:
-    txt_files = []
+catalog = RunCatalog()
+
+def run_options(extra=()):
+    # MultiChoice options (path, label): catalogued runs, then uploads and selected runs the catalog does not hold
+    options = [(row["path"], run_label(row)) for row in catalog.query(folder_path)]
+    known = {path for path, _ in options}
+    return options + [(path, path) for path in dict.fromkeys([*uploads, *current_files, *extra]) if path not in known]
+
+def refresh_runs():
+    # Pick up run files added or changed since the last look, the scan runs on the worker pool
+    run_in_background(document, ("catalog", folder_path), catalog.refresh, (folder_path,), runs_refreshed)
+
+def runs_refreshed(future):
+    future.result()
+    run_choice.options = run_options()
 
 bike_folder_path = "bike_profiles"
 if os.path.exists(bike_folder_path):  # Check if folder exists
@@ -274,61 +287,118 @@ else:
 
 bike_dropdown = Dropdown(label="Select a file", menu=bike_txt_files)
 
+uploads = {}  # Runs uploaded in this session: name -> (digest, raw run), never written to disk unless saving is on
+run_choice = MultiChoice(value=current_files, options=run_options())
 
-dropdown1 = Dropdown(label="Select file 1", menu=txt_files)
-dropdown2 = Dropdown(label="Select file 2", menu=txt_files)
-
-def file1_selected(event):
-    global current_file1
-    current_file1 = folder_path + "/" + event.item
-    main(current_file1, current_file2, current_bike_file)
-
-def file2_selected(event):
-    global current_file2
-    current_file2 = folder_path + "/" + event.item
-    main(current_file1, current_file2, current_bike_file)
+def runs_selected(attr, old, new):
+    main(new, current_bike_file)
 
 def bike_selected(event):
-    main(current_file1, current_file2, bike_folder_path+"/"+event.item)
-
-dropdown1.on_event("menu_item_click", file1_selected)
-dropdown2.on_event("menu_item_click", file2_selected)
-
-# File upload callbacks
-def upload_callback1(attr, old, new):
-    global current_file1
-    decoded = base64.b64decode(new)
-    file_content = decoded.decode("utf-8")
-    temp_file_path = "run_data/uploaded_file1.txt"
-    with open(temp_file_path, "w", newline="") as f:
-        f.write(file_content)
-    current_file1 = temp_file_path
-    main(current_file1, current_file2, current_bike_file)
-
-def upload_callback2(attr, old, new):
-    global current_file2
-    decoded = base64.b64decode(new)
-    file_content = decoded.decode("utf-8")
-    temp_file_path = "run_data/uploaded_file2.txt"
-    with open(temp_file_path, "w", newline="") as f:
-        f.write(file_content)
-    current_file2 = temp_file_path
-    main(current_file1, current_file2, current_bike_file)
-
-file_input1 = FileInput(accept=".txt")
-file_input1.on_change("value", upload_callback1)
-
-file_input2 = FileInput(accept=".txt")
-file_input2.on_change("value", upload_callback2)
+    main(current_files, bike_folder_path+"/"+event.item)
+
+def alignment_toggled(attr, old, new):
+    main(current_files, current_bike_file)
+
+run_choice.on_change("value", runs_selected)
+
+# File upload callback - uploaded run is added to the comparison
+def upload_callback(attr, old, new):
+    # The browser sets the file name after the content, so read both on the next tick
+    document.add_next_tick_callback(process_upload)
+
+def process_upload():
+    # Parsed in memory on the worker pool
+    content = base64.b64decode(file_input.value)
+    loading_div.visible = True
+    run_in_background(document, ("upload", content), run_cache.upload, (content,), partial(upload_parsed, file_input.filename, content))
+
+def upload_parsed(filename, content, future):
+    # Kept for this session only, unless saving is switched on
+    digest, raw = future.result()
+    if save_uploads_toggle.active:
+        path = run_cache.save_upload(digest, content)
+        refresh_runs()
+    else:
+        path = f"upload: {filename}"
+        uploads[path] = (digest, raw)
+    run_choice.options = run_options([path])
+    if path in current_files:
+        main(current_files, current_bike_file)
+    else:
+        run_choice.value = current_files + [path]
+
+file_input = FileInput(accept=",".join(RUN_EXTENSIONS))
+file_input.on_change("value", upload_callback)
+save_uploads_toggle = Toggle(label="Save uploads", active=False)
 
 bike_dropdown.on_event("menu_item_click", bike_selected)
 bike_select_text = Paragraph(text="Select bike here: ")
 
 # Layout
-file1_select_text = Paragraph(text="Select file 1 here: ")
-file2_select_text = Paragraph(text="Select file 2 here: ")
-
-top_select_layout = row(file1_select_text, file_input1, dropdown1, file2_select_text, file_input2, dropdown2, bike_dropdown)
+files_select_text = Paragraph(text="Select runs here: ")
+
+align_toggle = Toggle(label="Align runs", active=False)
+align_toggle.on_change("active", alignment_toggled)
+difference_toggle = Toggle(label="Difference", active=False)
+difference_toggle.on_change("active", alignment_toggled)
+
+loading_div = Div(text="<em>Loading...</em>", visible=False)
+top_select_layout = row(files_select_text, run_choice, file_input, save_uploads_toggle, bike_select_text, bike_dropdown,
+                        align_toggle, difference_toggle, loading_div)
+
+# Build the document once, selections only update its data
+plots = {}
+displacement_lods = {}
+for channel in ["fork", "shock"]:
+    graphs = {"displacement": decomposed_displacement_plot()}
+    graphs["displacement_slots"] = [add_displacement_run(graphs["displacement"]) for _ in range(PREALLOCATED_RUNS)]
+    graphs["displacement"].on_event(RangesUpdate, displacement_range_changed(graphs["displacement"], graphs["displacement_slots"]))
+    show_slots(graphs["displacement"], graphs["displacement_slots"], 0)
+    graphs["difference"], graphs["difference_source"] = decomposed_difference_plot(graphs["displacement"].x_range)
+    graphs["difference"].visible = False
+    for kind in ["Compression", "Rebound"]:
+        graphs[kind], graphs[kind + "_mean"] = decomposed_regression_plot(kind)
+        graphs[kind + "_slots"] = [add_regression_run(graphs[kind]) for _ in range(PREALLOCATED_RUNS)]
+        show_slots(graphs[kind], graphs[kind + "_slots"], 0)
+    plots[channel] = graphs
+
+# Configure graphs
+for graphs in plots.values():
+    for graph in [graphs["displacement"], graphs["Compression"], graphs["Rebound"]]:
+        graph.toolbar.logo = None
+
+# Create headers and subheadings
+head = Div(text="<h1 style='font-size:40px;'>Comparison of Accelerometer Data</h1>")
+fork_subheading = Div(text="<h2 style='font-size:30px;'>Fork Values</h2>")
+shock_subheading = Div(text="<h2 style='font-size:30px;'>Shock Values</h2>")
+displacement_subsubheading1 = Div(text="<h3 style='font-size:25px;'>Displacement Plot</h3>")
+regression_subsubheading1 = Div(text="<h3 style='font-size:25px;'>Regression Lines</h3>")
+displacement_subsubheading2 = Div(text="<h3 style='font-size:25px;'>Displacement Plot</h3>")
+regression_subsubheading2 = Div(text="<h3 style='font-size:25px;'>Regression Lines</h3>")
+
+# Create dashboard layout
+dashboard_layout = column(
+    fork_subheading,
+    displacement_subsubheading1,
+    plots["fork"]["displacement"],
+    plots["fork"]["difference"],
+    regression_subsubheading1,
+    row(plots["fork"]["Compression"], plots["fork"]["Rebound"], sizing_mode='stretch_width'),
+    shock_subheading,
+    displacement_subsubheading2,
+    plots["shock"]["displacement"],
+    plots["shock"]["difference"],
+    regression_subsubheading2,
+    row(plots["shock"]["Compression"], plots["shock"]["Rebound"], sizing_mode='stretch_width'),
+    sizing_mode="stretch_both"
+)
+layout = column(head, top_select_layout, dashboard_layout, sizing_mode="stretch_both")
+
+# Set theme and display
+document.theme = "dark_minimal"
+document.add_root(layout)
+document.add_periodic_callback(refresh_runs, CATALOG_REFRESH_MS)
+refresh_runs()
 
 # Initialize the dashboard
-main(current_file1, current_file2, current_bike_file)
\ No newline at end of file
+main(current_files, current_bike_file)
@@ -1,200 +1,138 @@
 from bokeh.io import curdoc
-from bokeh.plotting import figure, show
-from bokeh.models import Range1d, Div, TextInput, FileInput, Dropdown, Paragraph, Button
+from bokeh.models import Div, TextInput, FileInput, Dropdown, Paragraph, Toggle
 from bokeh.layouts import grid, row, column
-from accelerometer_data_processor import process_accelerometer_file
+from bokeh.events import RangesUpdate, SelectionGeometry
+from accelerometer_data_processor import process_bike_data
+from run_cache import run_cache
+from downsampling import LevelOfDetail
+from range_stats import RunIndex
+from dashboard_figures import (create_sources, create_displacement_plot, update_displacement_plot, update_displacement_line,
+                               create_compression_plot, create_rebound_plot, update_regression_plot, create_spectrum_plot,
+                               create_transfer_plot, update_spectrum_plots, create_stats_div, update_stats_div, update_window_div,
+                               create_diagnostics_div, update_diagnostics_div, serialise_sources)
+from workers import run_in_background
+from run_catalog import RunCatalog, run_label
+from run_format import RUN_EXTENSIONS
+from functools import partial
+import instrumentation
 import base64
 import os
-import numpy as np
 
+CATALOG_REFRESH_MS = 30000  # How often the run folder is checked for new or changed files
+
+# bokeh serve runs this script once per session, so these globals and the document below belong to one session
+# Only run_cache, the worker pool and the run catalog file are shared between sessions
 current_data_file = "run_data/testrun2.txt"
 current_bike_file = "bike_profiles/wills_megatower.txt"
+request_count = 0  # Latest selection, older results arriving late are ignored
+document = curdoc()
 
 
-def load_and_process_data(file_path, bike_data):
-    # Load and process accelerometer data from a file.
-    data = process_accelerometer_file(file_path, bike_data)
+def load_and_process_data(file_path, bike_data, regression="ols"):
+    # Load and process accelerometer data from a file or an upload of this session, reusing cached raw arrays and results.
+    if file_path in uploads:
+        digest, raw = uploads[file_path]
+        return run_cache.upload_result(digest, raw, bike_data, regression=regression)
+    data = run_cache.result(file_path, bike_data, regression=regression)
     return data
 
-def process_bike_data(file_path):
-    values = []
-
-    with open(file_path, 'r') as file:
-        for line in file:
-            parts = line.strip().split(":")  # Split by ':'
-            if len(parts) == 2:  # Ensure there are two parts (key and value)
-                key, value = parts[0].strip(), parts[1].strip()
-                if key in ["rear_sus_min", "rear_sus_max", "front_sus_min", "front_sus_max"]:
-                    values.append(int(value))  # Convert to integer and store
-
-    return values
-
-def create_displacement_plot(data, file_name, bike_file):
-    # Create a displacement plot using the processed data.
-    time_of_run = data["timeOfRun"]
-    x_values = data["xValues"]
-    y_fork_values = data["yForkValues"]
-    y_shock_values = data["yShockValues"]
-    fork_peak_times = data["forkPeakTimes"]
-    fork_peaks = data["forkPeaks"]
-    fork_trough_times = data["forkTroughTimes"]
-    fork_troughs = data["forkTroughs"]
-    shock_peak_times = data["shockPeakTimes"]
-    shock_peaks = data["shockPeaks"]
-    shock_trough_times = data["shockTroughTimes"]
-    shock_troughs = data["shockTroughs"]
-
-    displacement_graph = figure(
-        title=f"Percentage Displacement Plot: {file_name}, {bike_file}",
-        sizing_mode="stretch_width",
-        height=450,
-        x_axis_label="Time (s)",
-        y_axis_label="Percentage displacement (%)",
-        tools="pan, reset, wheel_zoom, xwheel_zoom, fullscreen, examine, crosshair",
-    )
-    displacement_graph.x_range = Range1d(start=0, end=time_of_run, bounds=(0, time_of_run))
-    displacement_graph.y_range = Range1d(start=0, end=100, bounds=(0, 100))
-
-    displacement_graph.line(x_values, y_fork_values, legend_label="Front Fork", color="#00FFFF", line_width=0.5)
-    displacement_graph.scatter(fork_peak_times, fork_peaks, color="red", size=2, legend_label="Fork Peaks", marker="circle")
-    displacement_graph.scatter(fork_trough_times, fork_troughs, color="orange", size=2, legend_label="Fork Troughs", marker="circle")
-
-    displacement_graph.line(x_values, y_shock_values, legend_label="Rear Shock", color="#FF9500", line_width=0.5)
-    displacement_graph.scatter(shock_peak_times, shock_peaks, color="red", size=2, legend_label="Shock Peaks", marker="circle")
-    displacement_graph.scatter(shock_trough_times, shock_troughs, color="orange", size=2, legend_label="Shock Troughs", marker="circle")
-
-    return displacement_graph
-
-def create_compression_plot(data, file_name):
-    # Create a compression scatter plot using the processed data.
-    fork_compression_speed = data["forkCompressionSpeed"]
-    fork_compression_displacement = data["forkCompressionDisplacement"]
-    fork_compression_regress = data["forkCompression_regress"]
-    shock_compression_speed = data["shockCompressionSpeed"]
-    shock_compression_displacement = data["shockCompressionDisplacement"]
-    shock_compression_regress = data["shockCompression_regress"]
-    speedFR = sorted(fork_compression_speed)[int(len(fork_compression_speed)*0.9)]
-    speedSR = sorted(shock_compression_speed)[int(len(shock_compression_speed)*0.9)]
-    rangeSpeed = max(speedFR, speedSR)
-
-    comp_graph = figure(
-        title=f"Compression Scatter Plot: {file_name}",
-        sizing_mode="stretch_width",
-        height=450,
-        x_axis_label="Speed of displacement (%/s)",
-        y_axis_label="Absolute change in displacement (%)",
-        tools="pan, reset, wheel_zoom, xwheel_zoom, fullscreen, examine, crosshair",
-    )
-
-    comp_graph.x_range = Range1d(start=0, end=rangeSpeed * 1.1)
-    comp_graph.y_range = Range1d(start=0, end=max(max(fork_compression_displacement), max(shock_compression_displacement)) * 1.1)
-
-    comp_graph.scatter(fork_compression_speed, fork_compression_displacement, color="blue", size=4, legend_label="Fork Compression", marker="circle")
-    comp_graph.line(x=fork_compression_regress, y=fork_compression_displacement, color="#00FFFF", legend_label="Fork Regression", line_width=2)
-
-    comp_graph.scatter(shock_compression_speed, shock_compression_displacement, color="orange", size=4, legend_label="Shock Compression", marker="circle")
-    comp_graph.line(x=shock_compression_regress, y=shock_compression_displacement, color="red", legend_label="Shock Regression", line_width=2)
-
-    mean_x = [(min(fork_compression_regress)+min(shock_compression_regress))/2,(max(fork_compression_regress)+max(shock_compression_regress))/2]
-    mean_y = [(min(fork_compression_displacement)+min(shock_compression_displacement))/2,(max(fork_compression_displacement)+max(shock_compression_displacement))/2]
-
-    comp_graph.line(x=mean_x, y=mean_y, color="white", legend_label="Mean Compression Regression", line_width=2)
-
-    return comp_graph
-
-def create_rebound_plot(data, file_name):
-    # Create a rebound scatter plot using the processed data.
-    fork_rebound_speed = data["forkReboundSpeed"]
-    fork_rebound_displacement = data["forkReboundDisplacement"]
-    fork_rebound_regress = data["forkRebound_regress"]
-    shock_rebound_speed = data["shockReboundSpeed"]
-    shock_rebound_displacement = data["shockReboundDisplacement"]
-    shock_rebound_regress = data["shockRebound_regress"]
-    speedFR = sorted(fork_rebound_speed)[int(len(fork_rebound_speed)*0.9)]
-    speedSR = sorted(shock_rebound_speed)[int(len(shock_rebound_speed)*0.9)]
-    rangeSpeed = max(speedFR, speedSR)
-
-
-    reb_graph = figure(
-        title=f"Rebound Scatter Plot: {file_name}",
-        sizing_mode="stretch_width",
-        height=450,
-        x_axis_label="Speed of displacement (%/s)",
-        y_axis_label="Absolute change in displacement (%)",
-        tools="pan, reset, wheel_zoom, xwheel_zoom, fullscreen, examine, crosshair",
-    )
-    reb_graph.x_range = Range1d(start=0, end=rangeSpeed * 1.1)
-    reb_graph.y_range = Range1d(start=0, end=max(max(fork_rebound_displacement), max(shock_rebound_displacement)) * 1.1)
-
-    reb_graph.scatter(fork_rebound_speed, fork_rebound_displacement, color="blue", size=4, legend_label="Fork Rebound", marker="circle")
-    reb_graph.line(x=fork_rebound_regress, y=fork_rebound_displacement, color="#00FFFF", legend_label="Fork Regression", line_width=2)
-
-    reb_graph.scatter(shock_rebound_speed, shock_rebound_displacement, color="orange", size=4, legend_label="Shock Rebound", marker="circle")
-    reb_graph.line(x=shock_rebound_regress, y=shock_rebound_displacement, color="red", legend_label="Shock Regression", line_width=2)
-
-    mean_x = [(min(fork_rebound_regress)+min(shock_rebound_regress))/2,(max(fork_rebound_regress)+max(shock_rebound_regress))/2]
-    mean_y = [(min(fork_rebound_displacement)+min(shock_rebound_displacement))/2,(max(fork_rebound_displacement)+max(shock_rebound_displacement))/2]
-
-    reb_graph.line(x=mean_x, y=mean_y, color="white", legend_label="Mean Rebound Regression", line_width=2)
-
-    return reb_graph
-
-def create_stats_div(data):
-    # Create a Div element to display statistics.
-    text_data = data["textData"]
-    html_content = f"<pre><strong>{text_data}</strong></pre>"
-    stats_div = Div(text=html_content)
-    return stats_div
+def displacement_range_changed(event):
+    # Re-request a finer (or coarser) slice after zoom or pan, with the statistics of the visible window.
+    if displacement_lod is not None:
+        update_displacement_line(sources["displacement"], displacement_lod, event.x0, event.x1)
+    if displacement_index is not None:
+        update_window_div(window_div, displacement_index, event.x0, event.x1)
+
+def displacement_selected(event):
+    # Statistics of the box-selected section, sent on every move of the box.
+    if displacement_index is not None and event.geometry.get("type") == "rect":
+        update_window_div(window_div, displacement_index, event.geometry["x0"], event.geometry["x1"])
+
+def load_run(run_data_file, bike_file, regression, diagnostics):
+    # Worker side of main: everything heavy, nothing that touches the document. Catalogued runs get their summary recorded
+    # Stages are recorded for this request only when diagnostics are on, and returned with the result
+    with instrumentation.recording(diagnostics) as records:
+        bike_data = process_bike_data(bike_file)
+        data = load_and_process_data(run_data_file, bike_data, regression)
+        if data is None:
+            return None, None, None, records
+        if run_data_file not in uploads:
+            catalog.record_summary(run_data_file, bike_file, bike_data, data)
+        with instrumentation.timed("range index", samples=len(data.time)):
+            index = RunIndex(data)
+        with instrumentation.timed("level of detail", samples=len(data.time)):
+            lod = LevelOfDetail(data.xValues, [data.fork.values, data.shock.values])
+    return data, index, lod, records
 
 def main(run_data_file, bike_file):
-    global current_data_file
+    # Queue the selected run on the worker pool, show_run updates the document when it is ready
+    global current_data_file, current_bike_file, request_count
     current_data_file = run_data_file
-    curdoc().clear()
-    top_select_layout = row(file_select_text,file_input, file_dropdown, bike_select_text, bike_dropdown)
-    # Load and process data
-    bike_data = process_bike_data(bike_file)
-    data = load_and_process_data(run_data_file, bike_data)
+    current_bike_file = bike_file
+    request_count += 1
+    upload = uploads.get(run_data_file)
+    regression = "theil-sen" if robust_toggle.active else "ols"
+    diagnostics = diagnostics_toggle.active
+    key = ("run", upload[0] if upload else run_data_file, bike_file, regression, diagnostics)  # Uploads are identified by content across sessions
+    loading_div.visible = True
+    run_in_background(document, key, load_run, (run_data_file, bike_file, regression, diagnostics), partial(show_run, request_count))
+
+def show_run(request, future):
+    # Runs on the event loop once the worker is done. Results of a superseded selection are dropped
+    global displacement_lod, displacement_index
+    if request != request_count:
+        return
+    loading_div.visible = False
+    data, displacement_index, displacement_lod, records = future.result()
+    run_data_file, bike_file = current_data_file, current_bike_file
 
     if data is not None:
-        # Create plots
-        displacement_graph = create_displacement_plot(data, run_data_file, bike_file)
-        comp_graph = create_compression_plot(data, run_data_file)
-        reb_graph = create_rebound_plot(data, run_data_file)
-
-        # Create stats div
-        stats_div = create_stats_div(data)
-
-        # Configure graphs
-        for graph in [displacement_graph, comp_graph, reb_graph]:
-            graph.toolbar.logo = None
-            graph.legend.click_policy = "hide"
-
-        # Create dashboard layout
-        dashboard_layout = grid(
-            [[displacement_graph], [comp_graph, reb_graph], [stats_div]],
-            sizing_mode="stretch_both"
-        )
+        # Update plots and stats in place
+        update_displacement_plot(displacement_graph, sources["displacement"], data, displacement_lod, run_data_file, bike_file)
+        update_regression_plot(comp_graph, sources["Compression"], data, "Compression", run_data_file)
+        update_regression_plot(reb_graph, sources["Rebound"], data, "Rebound", run_data_file)
+        update_spectrum_plots(psd_graph, transfer_graph, sources["Spectrum"], data, run_data_file)
+        update_stats_div(stats_div, data)
+        update_window_div(window_div, displacement_index, 0, data.timeOfRun)
+
+        if diagnostics_toggle.active:
+            with instrumentation.recording() as serialising, instrumentation.timed("serialise", samples=len(data.time)):
+                serialise_sources(sources)
+            update_diagnostics_div(diagnostics_div, records + serialising)
+
+    dashboard_layout.visible = data is not None
+
+def robust_toggled(attr, old, new):
+    # Refit the compression and rebound slopes of the current run with the chosen regression.
+    main(current_data_file, current_bike_file)
 
+def diagnostics_toggled(attr, old, new):
+    # Show or hide the diagnostics and reload the current run, recorded for this session only when they are on.
+    diagnostics_div.visible = new
+    main(current_data_file, current_bike_file)
 
-        layout = column(top_select_layout, dashboard_layout, sizing_mode="stretch_both")
-    else:
 
-        layout = column(top_select_layout, sizing_mode="stretch_both")
+run_folder_path = "run_data"
+catalog = RunCatalog()
 
+def catalog_menu():
+    # Dropdown items (label, path) of the catalogued runs matching the filter
+    return [(run_label(row), row["path"]) for row in catalog.query(run_folder_path, name=run_filter.value or None)]
 
-    # Set theme and display
-    curdoc().theme = "dark_minimal"
-    curdoc().clear()
-    curdoc().add_root(layout)
+def refresh_runs():
+    # Pick up run files added or changed since the last look, the scan runs on the worker pool
+    run_in_background(document, ("catalog", run_folder_path), catalog.refresh, (run_folder_path,), runs_refreshed)
 
+def runs_refreshed(future):
+    future.result()
+    file_dropdown.menu = catalog_menu()
 
-run_folder_path = "run_data"
-if os.path.exists(run_folder_path):  # Check if folder exists
-    run_txt_files = [(file, file) for file in os.listdir(run_folder_path) if file.lower().endswith(".txt")]
-else:
-    run_txt_files = []
+def run_filter_changed(attr, old, new):
+    file_dropdown.menu = catalog_menu()
 
-file_dropdown = Dropdown(label="Select a file", menu=run_txt_files)
+run_filter = TextInput(placeholder="Filter runs", width=120)
+run_filter.on_change("value", run_filter_changed)
+file_dropdown = Dropdown(label="Select a file", menu=catalog_menu())
 
 bike_folder_path = "bike_profiles"
 if os.path.exists(bike_folder_path):  # Check if folder exists
@@ -206,7 +144,7 @@ bike_dropdown = Dropdown(label="Select a file", menu=bike_txt_files)
 
 
 def file_selected(event):
-    main(run_folder_path+"/"+event.item, current_bike_file)
+    main(event.item, current_bike_file)
 
 def bike_selected(event):
     main(current_data_file, bike_folder_path+"/"+event.item)
@@ -215,24 +153,31 @@ def on_suspension_change(attr, old, new):
     main(current_data_file)
 
 def upload_callback(attr, old, new):
-    global current_data_file
-
-    # Decode the uploaded file content
-    decoded = base64.b64decode(new)
-    file_content = decoded.decode("utf-8")
-
-    # Save the file temporarily
-    temp_file_path = "run_data/uploaded_file.txt"
-    with open(temp_file_path, "w", newline="") as f:
-        f.write(file_content)
-
-    # Update the current file and refresh the dashboard
-    current_data_file = temp_file_path
-    main(current_data_file, current_bike_file)
+    # The browser sets the file name after the content, so read both on the next tick
+    document.add_next_tick_callback(process_upload)
+
+def process_upload():
+    # Parse the upload in memory on the worker pool
+    content = base64.b64decode(file_input.value)
+    loading_div.visible = True
+    run_in_background(document, ("upload", content), run_cache.upload, (content,), partial(upload_parsed, file_input.filename, content))
+
+def upload_parsed(filename, content, future):
+    # Keep the parsed upload for this session only, unless saving is switched on.
+    digest, raw = future.result()
+    if save_uploads_toggle.active:
+        path = run_cache.save_upload(digest, content)
+        refresh_runs()
+    else:
+        path = f"upload: {filename}"
+        uploads[path] = (digest, raw)
+    main(path, current_bike_file)
 
 
-file_input = FileInput(accept=".txt")
+uploads = {}  # Runs uploaded in this session: name -> (digest, raw run), never written to disk unless saving is on
+file_input = FileInput(accept=",".join(RUN_EXTENSIONS))
 file_input.on_change("value", upload_callback)
+save_uploads_toggle = Toggle(label="Save uploads", active=False)
 
 file_dropdown.on_event("menu_item_click", file_selected)
 file_select_text = Paragraph(text="Select file here: ")
@@ -240,4 +185,43 @@ file_select_text = Paragraph(text="Select file here: ")
 bike_dropdown.on_event("menu_item_click", bike_selected)
 bike_select_text = Paragraph(text="Select bike here: ")
 
+# Build the document once, selections only update its data
+sources = create_sources()
+displacement_lod = None
+displacement_index = None
+displacement_graph = create_displacement_plot(sources["displacement"])
+displacement_graph.on_event(RangesUpdate, displacement_range_changed)
+displacement_graph.on_event(SelectionGeometry, displacement_selected)
+comp_graph = create_compression_plot(sources["Compression"])
+reb_graph = create_rebound_plot(sources["Rebound"])
+psd_graph = create_spectrum_plot(sources["Spectrum"])
+transfer_graph = create_transfer_plot(sources["Spectrum"])
+stats_div = create_stats_div()
+window_div = create_stats_div()
+diagnostics_div = create_diagnostics_div()
+loading_div = Div(text="<em>Loading...</em>", visible=False)
+diagnostics_toggle = Toggle(label="Diagnostics", active=False)
+diagnostics_toggle.on_change("active", diagnostics_toggled)
+robust_toggle = Toggle(label="Robust slopes", active=False)  # Theil-Sen instead of least squares
+robust_toggle.on_change("active", robust_toggled)
+
+# Configure graphs
+for graph in [displacement_graph, comp_graph, reb_graph, psd_graph, transfer_graph]:
+    graph.toolbar.logo = None
+    graph.legend.click_policy = "hide"
+
+# Create dashboard layout
+top_select_layout = row(file_select_text, file_input, save_uploads_toggle, run_filter, file_dropdown, bike_select_text, bike_dropdown, robust_toggle, diagnostics_toggle, loading_div)
+dashboard_layout = grid(
+    [[displacement_graph], [comp_graph, reb_graph], [psd_graph, transfer_graph], [stats_div, window_div, diagnostics_div]],
+    sizing_mode="stretch_both"
+)
+layout = column(top_select_layout, dashboard_layout, sizing_mode="stretch_both")
+
+# Set theme and display
+document.theme = "dark_minimal"
+document.add_root(layout)
+document.add_periodic_callback(refresh_runs, CATALOG_REFRESH_MS)
+refresh_runs()
+
 main(current_data_file, current_bike_file)
\ No newline at end of file
@@ -0,0 +1,229 @@
+# dashboard_figures.py
+# Figures, data sources and stats divs of the single-run dashboard, built and filled without a server document
+# Importing this has no side effects, so the benchmark can time figure construction without starting the app
+
+from bokeh.plotting import figure
+from bokeh.models import Range1d, Div, ColumnDataSource, BoxSelectTool
+from bokeh.core.serialization import Serializer
+from histograms import format_histograms
+from instrumentation import instrumented
+import instrumentation
+import numpy as np
+
+
+@instrumented("figure")
+def create_displacement_plot(sources):
+    # Create a displacement plot drawn from persistent sources, filled in by update_displacement_plot.
+    displacement_graph = figure(
+        title="Percentage Displacement Plot",
+        sizing_mode="stretch_width",
+        height=450,
+        x_axis_label="Time (s)",
+        y_axis_label="Percentage displacement (%)",
+        tools="pan, reset, wheel_zoom, xwheel_zoom, fullscreen, examine, crosshair",
+    )
+    displacement_graph.add_tools(BoxSelectTool(dimensions="width", continuous=True))  # Drag to get statistics of a section
+    displacement_graph.x_range = Range1d(start=0, end=1, bounds=(0, 1))
+    displacement_graph.y_range = Range1d(start=0, end=100, bounds=(0, 100))
+
+    displacement_graph.line("x", "fork", source=sources["line"], legend_label="Front Fork", color="#00FFFF", line_width=0.5)
+    displacement_graph.scatter("x", "y", source=sources["forkPeaks"], color="red", size=2, legend_label="Fork Peaks", marker="circle")
+    displacement_graph.scatter("x", "y", source=sources["forkTroughs"], color="orange", size=2, legend_label="Fork Troughs", marker="circle")
+
+    displacement_graph.line("x", "shock", source=sources["line"], legend_label="Rear Shock", color="#FF9500", line_width=0.5)
+    displacement_graph.scatter("x", "y", source=sources["shockPeaks"], color="red", size=2, legend_label="Shock Peaks", marker="circle")
+    displacement_graph.scatter("x", "y", source=sources["shockTroughs"], color="orange", size=2, legend_label="Shock Troughs", marker="circle")
+
+    return displacement_graph
+
+@instrumented("figure update", samples=lambda args, result: len(args[2].time))
+def update_displacement_plot(graph, sources, data, lod, file_name, bike_file):
+    # Replace the displacement data arrays, range and title in place, drawing the line from the run's level of detail.
+    time_of_run = data.timeOfRun
+    fork, shock = data.fork, data.shock
+    update_displacement_line(sources, lod)
+    sources["forkPeaks"].data = dict(x=fork.peakTimes, y=fork.peaks)
+    sources["forkTroughs"].data = dict(x=fork.troughTimes, y=fork.troughs)
+    sources["shockPeaks"].data = dict(x=shock.peakTimes, y=shock.peaks)
+    sources["shockTroughs"].data = dict(x=shock.troughTimes, y=shock.troughs)
+
+    graph.title.text = f"Percentage Displacement Plot: {file_name}, {bike_file}"
+    graph.x_range.update(start=0, end=time_of_run, bounds=(0, time_of_run))
+
+def update_displacement_line(sources, lod, x0=None, x1=None):
+    # Send only the decimated fork and shock samples for the visible window.
+    indexes = lod.window(x0, x1)
+    fork, shock = lod.channels
+    sources["line"].data = dict(x=lod.x[indexes], fork=fork[indexes], shock=shock[indexes])
+
+@instrumented("figure")
+def create_regression_plot(sources, kind):
+    # Create a compression or rebound scatter plot drawn from persistent sources, filled in by update_regression_plot.
+    graph = figure(
+        title=f"{kind} Scatter Plot",
+        sizing_mode="stretch_width",
+        height=450,
+        x_axis_label="Speed of displacement (%/s)",
+        y_axis_label="Absolute change in displacement (%)",
+        tools="pan, reset, wheel_zoom, xwheel_zoom, fullscreen, examine, crosshair",
+    )
+    graph.x_range = Range1d(start=0, end=1)
+    graph.y_range = Range1d(start=0, end=1)
+
+    graph.scatter("speed", "displacement", source=sources["fork"], color="blue", size=4, legend_label=f"Fork {kind}", marker="circle")
+    graph.line("regress", "displacement", source=sources["fork"], color="#00FFFF", legend_label="Fork Regression", line_width=2)
+
+    graph.scatter("speed", "displacement", source=sources["shock"], color="orange", size=4, legend_label=f"Shock {kind}", marker="circle")
+    graph.line("regress", "displacement", source=sources["shock"], color="red", legend_label="Shock Regression", line_width=2)
+
+    graph.line("x", "y", source=sources["mean"], color="white", legend_label=f"Mean {kind} Regression", line_width=2)
+
+    return graph
+
+def create_compression_plot(sources):
+    # Create a compression scatter plot.
+    return create_regression_plot(sources, "Compression")
+
+def create_rebound_plot(sources):
+    # Create a rebound scatter plot.
+    return create_regression_plot(sources, "Rebound")
+
+@instrumented("figure update", samples=lambda args, result: sum(len(getattr(channel, args[3].lower() + "Speed")) for channel in (args[2].fork, args[2].shock)))
+def update_regression_plot(graph, sources, data, kind, file_name):
+    # Replace the compression or rebound scatter data, ranges and title in place. Channels with no samples are left out of the ranges.
+    prefix = kind.lower()
+    fits = []
+    for name in ["fork", "shock"]:
+        channel = data.channel(name)
+        speed = getattr(channel, prefix + "Speed")
+        displacement = getattr(channel, prefix + "Displacement")
+        regress = getattr(channel, prefix + "Regress")
+        sources[name].data = dict(speed=speed, displacement=displacement, regress=regress)
+        if len(speed):
+            fits.append((np.sort(speed)[int(len(speed)*0.9)], displacement, regress))
+
+    if fits:
+        mean_x = [np.mean([np.min(regress) for _, _, regress in fits]), np.mean([np.max(regress) for _, _, regress in fits])]
+        mean_y = [np.mean([np.min(displacement) for _, displacement, _ in fits]), np.mean([np.max(displacement) for _, displacement, _ in fits])]
+    else:
+        mean_x, mean_y = [], []
+    sources["mean"].data = dict(x=mean_x, y=mean_y)
+    rangeSpeed = max((speed for speed, _, _ in fits), default=1)
+    rangeDisplacement = max((np.max(displacement) for _, displacement, _ in fits), default=1)
+
+    graph.title.text = f"{kind} Scatter Plot: {file_name}"
+    graph.x_range.update(start=0, end=rangeSpeed * 1.1)
+    graph.y_range.update(start=0, end=rangeDisplacement * 1.1)
+
+@instrumented("figure")
+def create_spectrum_plot(sources):
+    # Create a log-log power spectral density plot of fork and shock travel and chassis acceleration, filled in by update_spectrum_plots.
+    graph = figure(
+        title="Power Spectral Density",
+        sizing_mode="stretch_width",
+        height=450,
+        x_axis_type="log",
+        y_axis_type="log",
+        x_axis_label="Frequency (Hz)",
+        y_axis_label="PSD (%²/Hz, chassis (m/s²)²/Hz)",
+        tools="pan, reset, wheel_zoom, xwheel_zoom, fullscreen, examine, crosshair",
+    )
+    graph.line("frequency", "fork", source=sources["spectrum"], color="#00FFFF", legend_label="Front Fork", line_width=2)
+    graph.line("frequency", "shock", source=sources["spectrum"], color="#FF9500", legend_label="Rear Shock", line_width=2)
+    graph.line("frequency", "accel", source=sources["spectrum"], color="white", legend_label="Chassis Acceleration", line_width=1)
+    return graph
+
+@instrumented("figure")
+def create_transfer_plot(sources):
+    # Create a plot of travel per unit chassis acceleration against frequency, filled in by update_spectrum_plots.
+    graph = figure(
+        title="Transfer Ratio",
+        sizing_mode="stretch_width",
+        height=450,
+        x_axis_type="log",
+        y_axis_type="log",
+        x_axis_label="Frequency (Hz)",
+        y_axis_label="Travel per chassis acceleration (% per m/s²)",
+        tools="pan, reset, wheel_zoom, xwheel_zoom, fullscreen, examine, crosshair",
+    )
+    graph.line("frequency", "forkRatio", source=sources["spectrum"], color="#00FFFF", legend_label="Front Fork", line_width=2)
+    graph.line("frequency", "shockRatio", source=sources["spectrum"], color="#FF9500", legend_label="Rear Shock", line_width=2)
+    return graph
+
+@instrumented("figure update", samples=lambda args, result: len(args[3].time))
+def update_spectrum_plots(psd_graph, transfer_graph, sources, data, file_name):
+    # Replace the spectra in place. The DC bin is left out, it has no place on a log frequency axis.
+    spectra = data.spectra
+    if spectra is None or len(spectra.frequencies) < 2:
+        sources["spectrum"].data = {name: [] for name in sources["spectrum"].data}
+    else:
+        sources["spectrum"].data = dict(
+            frequency=spectra.frequencies[1:], fork=spectra.fork[1:], shock=spectra.shock[1:], accel=spectra.accel[1:],
+            forkRatio=spectra.forkRatio[1:], shockRatio=spectra.shockRatio[1:],
+        )
+    rate = f" ({spectra.sampleRate:.0f} samples/s)" if spectra is not None else ""
+    psd_graph.title.text = f"Power Spectral Density: {file_name}{rate}"
+    transfer_graph.title.text = f"Transfer Ratio: {file_name}"
+
+def create_stats_div():
+    # Create a Div element to display statistics.
+    return Div(text="")
+
+def update_stats_div(stats_div, data):
+    # Show the statistics for the current run.
+    text_data = data.textData
+    if data.shock.histogram is not None and data.fork.histogram is not None:
+        text_data += "\n" + format_histograms(data.shock.histogram, data.fork.histogram)
+    stats_div.text = f"<pre><strong>{text_data}</strong></pre>"
+
+def update_window_div(window_div, index, x0, x1):
+    # Show the statistics of one time window of the current run, answered from its range index.
+    window_div.text = f"<pre><strong>{index.format(x0, x1)}</strong></pre>"
+
+def create_diagnostics_div():
+    # Collapsible per-stage timings, hidden until diagnostics are switched on.
+    return Div(text="", visible=False)
+
+def update_diagnostics_div(diagnostics_div, records):
+    # Show the stages recorded for the last load as a table, with the same records as JSON.
+    rows = ""
+    for record in records:
+        seconds = record.get("seconds", 0)
+        samples = record["samples"]
+        rate = f"{samples / seconds / 1e6:.1f}" if samples and seconds else ""
+        rows += (f"<tr><td>{'&nbsp;' * 4 * record['depth']}{record['stage']}</td><td>{record['function']}</td>"
+                 f"<td>{seconds * 1000:.2f}</td><td>{samples if samples is not None else ''}</td><td>{rate}</td>"
+                 f"<td>{record.get('alloc_delta_kib', 0):.0f}</td></tr>")
+    diagnostics_div.text = (
+        "<details open><summary><strong>Diagnostics</strong></summary>"
+        "<table><tr><th>Stage</th><th>Function</th><th>ms</th><th>Samples</th><th>M samples/s</th><th>Alloc KiB (process-wide)</th></tr>"
+        f"{rows}</table><p><em>Alloc KiB is the change in all traced memory of the server process over the stage, "
+        "so allocations by other sessions and threads meanwhile are counted too</em></p>"
+        f"<details><summary>JSON</summary><pre>{instrumentation.to_json(records)}</pre></details></details>"
+    )
+
+def serialise_sources(sources):
+    # Encode the data sent to the browser, timing what the websocket update costs.
+    for group in sources.values():
+        for source in group.values():
+            Serializer().serialize(source.data)
+
+def create_sources():
+    # Persistent data sources; selections only replace their data
+    return {
+        "displacement": {name: ColumnDataSource(data=dict(x=[], y=[])) for name in ["forkPeaks", "forkTroughs", "shockPeaks", "shockTroughs"]}
+        | {"line": ColumnDataSource(data=dict(x=[], fork=[], shock=[]))},
+        "Compression": {
+            "fork": ColumnDataSource(data=dict(speed=[], displacement=[], regress=[])),
+            "shock": ColumnDataSource(data=dict(speed=[], displacement=[], regress=[])),
+            "mean": ColumnDataSource(data=dict(x=[], y=[])),
+        },
+        "Rebound": {
+            "fork": ColumnDataSource(data=dict(speed=[], displacement=[], regress=[])),
+            "shock": ColumnDataSource(data=dict(speed=[], displacement=[], regress=[])),
+            "mean": ColumnDataSource(data=dict(x=[], y=[])),
+        },
+        "Spectrum": {
+            "spectrum": ColumnDataSource(data=dict(frequency=[], fork=[], shock=[], accel=[], forkRatio=[], shockRatio=[])),
+        },
+    }
@@ -0,0 +1,59 @@
+# downsampling.py
+# Level of detail for the displacement line plots: a min/max pyramid per run so only about a screen width of points is sent
+
+import numpy as np
+from histograms import BOTTOM_OUT_THRESHOLD
+
+DEFAULT_POINTS = 2000  # Points sent per line for the visible window, roughly two per horizontal pixel
+
+
+def build_pyramid(y):
+    # Returns a list of (min_indexes, max_indexes) per level, level k holding one bucket per 2**k samples
+    indexes = np.arange(len(y))
+    levels = [(indexes, indexes)]
+    while len(levels[-1][0]) > 1:
+        prev_min, prev_max = levels[-1]
+        pairs = len(prev_min) // 2
+        a_min, b_min = prev_min[0:2 * pairs:2], prev_min[1:2 * pairs:2]
+        a_max, b_max = prev_max[0:2 * pairs:2], prev_max[1:2 * pairs:2]
+        level_min = np.where(y[a_min] <= y[b_min], a_min, b_min)
+        level_max = np.where(y[a_max] >= y[b_max], a_max, b_max)
+        if len(prev_min) % 2:  # Odd bucket out is carried up as a partial bucket
+            level_min = np.append(level_min, prev_min[-1])
+            level_max = np.append(level_max, prev_max[-1])
+        levels.append((level_min, level_max))
+    return levels
+
+
+class LevelOfDetail:
+    # Multi-resolution view of one run's displacement channels sharing a time axis
+    def __init__(self, x, channels):
+        self.x = np.asarray(x)
+        self.channels = [np.asarray(y) for y in channels]
+        self.pyramids = [build_pyramid(y) for y in self.channels]
+
+        # First sample of each entry into the bottom-out zone, so separate bottom-outs stay separate in the line
+        # Peaks and troughs are drawn from their own scatter sources and bucket maxima already reach the zone
+        forced = [np.flatnonzero(np.diff((y >= BOTTOM_OUT_THRESHOLD).astype(np.int8), prepend=0) > 0) for y in self.channels]
+        self.keep = np.unique(np.concatenate(forced)) if forced else np.zeros(0, dtype=np.intp)
+
+    def window(self, x0=None, x1=None, points=DEFAULT_POINTS):
+        # Returns sorted sample indexes to draw between x0 and x1 (whole run when not given)
+        n = len(self.x)
+        i0 = 0 if x0 is None else max(np.searchsorted(self.x, x0) - 1, 0)
+        i1 = n if x1 is None else min(np.searchsorted(self.x, x1) + 1, n)
+        if i1 - i0 <= points:
+            return np.arange(i0, i1)
+
+        # Finest level whose buckets fit the budget: a min and a max per channel and one bottom-out entry each
+        per_bucket = 2 * len(self.channels) + 1
+        level = int(np.ceil(np.log2((i1 - i0) * per_bucket / (points - 2))))
+        b0, b1 = i0 >> level, ((i1 - 1) >> level) + 1
+        keep = self.keep[(self.keep >= i0) & (self.keep < i1)]
+        _, first = np.unique(keep >> level, return_index=True)
+        selected = [[i0, i1 - 1], keep[first]]
+        for pyramid in self.pyramids:
+            level_min, level_max = pyramid[min(level, len(pyramid) - 1)]
+            selected += [level_min[b0:b1], level_max[b0:b1]]
+        indexes = np.unique(np.concatenate(selected))
+        return indexes[(indexes >= i0) & (indexes < i1)]
@@ -0,0 +1,98 @@
+# histograms.py
+# Fixed-size, mergeable travel and shaft-velocity histograms per channel (fork or shock)
+# Adding histograms aggregates runs, a test day or a season without going back to the raw data
+
+from dataclasses import dataclass
+import json
+import numpy as np
+from instrumentation import instrumented
+
+BOTTOM_OUT_THRESHOLD = 95  # Travel (%) at or above which a sample counts as a bottom-out
+TRAVEL_BINS = 100  # 1 % per bin over 0-100 %, travel outside the range is clipped into the end bins
+VELOCITY_BIN = 50  # %/s per velocity bin, about one ADC step per sample at the logged row rate
+VELOCITY_BINS = 40  # Compression and rebound each cover 0-2000 %/s, faster samples land in the last bin
+ZONES = ((0, 25), (25, 50), (50, 75), (75, 90), (90, 100))  # Travel zones (%) reported by time_in_zones
+
+
+@dataclass(slots=True)
+class TravelHistogram:
+    # Sample counts per bin. Compression is travel increasing between samples, rebound decreasing, still samples are in neither
+    travel: np.ndarray
+    compression: np.ndarray
+    rebound: np.ndarray
+    bottomOuts: int  # Entries into the bottom-out zone
+    seconds: float  # Time covered by the samples
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(TRAVEL_BINS, dtype=np.int64), np.zeros(VELOCITY_BINS, dtype=np.int64),
+                   np.zeros(VELOCITY_BINS, dtype=np.int64), 0, 0.0)
+
+    @property
+    def samples(self):
+        return int(self.travel.sum())
+
+    @property
+    def nbytes(self):
+        return self.travel.nbytes + self.compression.nbytes + self.rebound.nbytes + 16
+
+    def __add__(self, other):
+        return TravelHistogram(self.travel + other.travel, self.compression + other.compression, self.rebound + other.rebound,
+                               self.bottomOuts + other.bottomOuts, self.seconds + other.seconds)
+
+    def time_in_zones(self, zones=ZONES):
+        # Seconds spent in each travel zone
+        sample_time = self.seconds / self.samples if self.samples else 0.0
+        return [float(self.travel[low:high].sum() * sample_time) for low, high in zones]
+
+    def velocity_percentile(self, kind, q):
+        # Upper edge (%/s) of the velocity bin holding the q-th percentile of compression or rebound samples
+        counts = self.compression if kind == "compression" else self.rebound
+        if not counts.sum():
+            return float("nan")
+        return float((np.searchsorted(np.cumsum(counts), q / 100 * counts.sum()) + 1) * VELOCITY_BIN)
+
+    def to_dict(self):
+        return {"travel": self.travel.tolist(), "compression": self.compression.tolist(), "rebound": self.rebound.tolist(),
+                "bottomOuts": self.bottomOuts, "seconds": self.seconds}
+
+    @classmethod
+    def from_dict(cls, values):
+        # Accepts the dict written by to_dict or its JSON text, as stored in CSV summaries
+        if isinstance(values, str):
+            values = json.loads(values)
+        return cls(np.asarray(values["travel"], dtype=np.int64), np.asarray(values["compression"], dtype=np.int64),
+                   np.asarray(values["rebound"], dtype=np.int64), int(values["bottomOuts"]), float(values["seconds"]))
+
+
+def merge(histograms):
+    # Sum of any number of histograms, e.g. every run of a test day
+    return sum(histograms, TravelHistogram.empty())
+
+
+@instrumented("histogram", samples=lambda args, result: len(args[0]))
+def travel_histogram(y, sample_time):
+    # Histograms of travel (%) sampled every sample_time seconds, in bulk bincount passes
+    y = np.asarray(y)
+    if len(y) == 0:
+        return TravelHistogram.empty()
+    travel = np.bincount(np.clip(y, 0, TRAVEL_BINS - 1).astype(np.intp), minlength=TRAVEL_BINS)
+    velocity = np.diff(y) / sample_time if sample_time > 0 else np.zeros(0)
+    bins = np.minimum(np.abs(velocity) / VELOCITY_BIN, VELOCITY_BINS - 1).astype(np.intp)
+    compression = np.bincount(bins[velocity > 0], minlength=VELOCITY_BINS)
+    rebound = np.bincount(bins[velocity < 0], minlength=VELOCITY_BINS)
+    bottomedOut = y >= BOTTOM_OUT_THRESHOLD
+    bottomOuts = int(bottomedOut[0]) + int(np.count_nonzero(bottomedOut[1:] & ~bottomedOut[:-1]))
+    return TravelHistogram(travel.astype(np.int64), compression.astype(np.int64), rebound.astype(np.int64), bottomOuts, len(y) * sample_time)
+
+
+def format_histograms(shock, fork, zones=ZONES):
+    # Time in zone, bottom-outs and 95th percentile shaft velocities, laid out like format_data
+    text = "\n\t\t\tSHOCK:\t\tFORK:\n"
+    shockZones, forkZones = shock.time_in_zones(zones), fork.time_in_zones(zones)
+    for (low, high), shockTime, forkTime in zip(zones, shockZones, forkZones):
+        text += f"{low}-{high}% (s):\t\t{round(shockTime, 1)}\t\t{round(forkTime, 1)}\n"
+    text += f"Bottom-outs:\t\t{shock.bottomOuts}\t\t{fork.bottomOuts}\n"
+    for kind in ["compression", "rebound"]:
+        text += f"{kind.capitalize()} p95:\t\t{shock.velocity_percentile(kind, 95):.0f}\t\t{fork.velocity_percentile(kind, 95):.0f}\n"
+    return text.rstrip("\n")
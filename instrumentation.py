@@ -0,0 +1,105 @@
+# instrumentation.py
+# Optional per-stage timing, sample counts and allocation deltas. Off by default, instrumented functions then only pay one lookup
+# Recording is scoped to a block of one request: stages are kept per thread (or task), so concurrent sessions never see or
+# clear each other's records. Allocation tracing is process-wide and runs while any recording is open
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+_recording = ContextVar("recording", default=None)  # Recording of the block being run in this thread or task, if any
+_tracing_lock = threading.Lock()
+_tracing_users = 0  # Open recordings, tracemalloc stops with the last unless something else started it
+_tracing_owned = False
+
+
+class Recording:
+    # Stages recorded in call order, nested stages have a larger depth
+    def __init__(self):
+        self.records = []
+        self.depth = 0
+
+
+def _start_tracing():
+    global _tracing_users, _tracing_owned
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing_owned = True
+        _tracing_users += 1
+
+
+def _stop_tracing():
+    global _tracing_users, _tracing_owned
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0 and _tracing_owned:
+            tracemalloc.stop()
+            _tracing_owned = False
+
+
+@contextmanager
+def recording(on=True):
+    # Records the stages run inside the block by this thread or task and yields their list, filled as they finish
+    # With on false nothing is recorded and the list stays empty
+    if not on:
+        yield []
+        return
+    current = Recording()
+    token = _recording.set(current)
+    _start_tracing()
+    try:
+        yield current.records
+    finally:
+        _stop_tracing()
+        _recording.reset(token)
+
+
+def is_enabled():
+    # True inside a recording block
+    return _recording.get() is not None
+
+
+def to_json(records):
+    return json.dumps(records, indent=2)
+
+
+@contextmanager
+def timed(stage, samples=None, function=None):
+    # Records the enclosed block as one stage of the open recording, if any
+    current = _recording.get()
+    if current is None:
+        yield
+        return
+    before = tracemalloc.get_traced_memory()[0]
+    record = {"stage": stage, "function": function or stage, "depth": current.depth, "samples": samples}
+    current.records.append(record)
+    current.depth += 1
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        # Change in process-wide traced memory, includes whatever other threads allocated during the stage
+        record["alloc_delta_kib"] = (tracemalloc.get_traced_memory()[0] - before) / 1024
+        current.depth -= 1
+
+
+def instrumented(stage, samples=None):
+    # Decorator recording each call as a stage. samples(args, result) gives the sample count for the call
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recording.get() is None:
+                return func(*args, **kwargs)
+            with timed(stage, function=func.__name__) as record:
+                result = func(*args, **kwargs)
+                if samples is not None:
+                    record["samples"] = samples(args, result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,128 @@
+# live.py
+# Follow a run file while the logger is still recording and stream new samples into the displacement plot
+# Memory stays bounded while following: the browser keeps the last LIVE_WINDOW seconds and the server only the turning point history
+# Usage: python -m bokeh serve --show live.py --args run_data/RUN7.TXT bike_profiles/wills_megatower.txt
+
+from bokeh.io import curdoc
+from bokeh.plotting import figure
+from bokeh.models import ColumnDataSource, DataRange1d, Range1d, Div
+from bokeh.layouts import column
+from bokeh.events import RangesUpdate
+from accelerometer_data_processor import RunFileTail, TurningPointTracker, process_bike_data, normalise, format_data
+from downsampling import LevelOfDetail
+from run_cache import run_cache
+from spectral import sample_rate
+import sys
+import numpy as np
+
+current_data_file = sys.argv[1] if len(sys.argv) > 1 else "run_data/uploaded_file.txt"
+current_bike_file = sys.argv[2] if len(sys.argv) > 2 else "bike_profiles/wills_megatower.txt"
+
+POLL_PERIOD_MS = 250
+LIVE_WINDOW = 30  # Seconds of the run kept in view, and in the browser, while following
+
+
+class LiveChannel:
+    # Incremental state and plot sources for one suspension channel (fork or shock). Only the turning point tracker's
+    # short history is kept, the browser holds the last rollover points
+    def __init__(self, min_value, max_value):
+        self.min_value = min_value
+        self.max_value = max_value
+        self.tracker = TurningPointTracker(0.1)
+        self.peaks = ColumnDataSource(data=dict(x=[], y=[]))
+        self.troughs = ColumnDataSource(data=dict(x=[], y=[]))
+
+    def update(self, raw, sample_time, rollover):
+        # Normalises a chunk of raw ADC values and streams the turning points it confirms
+        y = normalise(raw, self.min_value, self.max_value)
+        peakIndexes, troughIndexes = self.tracker.update(y)
+        if len(peakIndexes):
+            self.peaks.stream(dict(x=peakIndexes * sample_time, y=self.tracker.values(peakIndexes)), rollover=rollover)
+        if len(troughIndexes):
+            self.troughs.stream(dict(x=troughIndexes * sample_time, y=self.tracker.values(troughIndexes)), rollover=rollover)
+        return y
+
+
+def poll():
+    # Reads newly appended rows and pushes only those to the browser, which keeps the last LIVE_WINDOW seconds
+    shock_raw, fork_raw = tail.read_new()
+    if len(shock_raw):
+        rate = sample_rate(0, None, tail.header or "")  # The header rate until the footer gives the real run time
+        rollover = int(LIVE_WINDOW * rate)
+        x = np.arange(tail.count - len(shock_raw), tail.count) / rate
+        shock_y = shock.update(shock_raw, 1 / rate, rollover)
+        fork_y = fork.update(fork_raw, 1 / rate, rollover)
+        line_source.stream(dict(x=x, shock=shock_y, fork=fork_y), rollover=rollover)
+        status_div.text = f"<pre>Following {current_data_file}: {tail.count} samples</pre>"
+
+    if tail.finished and tail.timeOfRun and not run_complete:
+        finish()
+
+
+def finish():
+    # Footer has arrived: load the whole run once, on its real time axis, and show the run statistics
+    # Only a level of detail of it is sent, refined as the view is zoomed
+    global run_complete, run_lod
+    run_complete = True
+    curdoc().remove_periodic_callback(poll_callback)
+    data = run_cache.result(current_data_file, bike_data)
+    run_lod = LevelOfDetail(data.xValues, [data.shock.values, data.fork.values])
+    update_line(run_lod)
+    for channel, result in ((shock, data.shock), (fork, data.fork)):
+        channel.peaks.data = dict(x=result.peakTimes, y=result.peaks)
+        channel.troughs.data = dict(x=result.troughTimes, y=result.troughs)
+
+    displacement_graph.x_range.follow = None
+    displacement_graph.x_range.start = 0
+    displacement_graph.x_range.end = tail.timeOfRun
+    status_div.text = f"<pre><strong>{current_data_file} finished\n{format_data(data.shock.summary(), data.fork.summary(), data.shock.intervals(), data.fork.intervals())}</strong></pre>"
+
+
+def update_line(lod, x0=None, x1=None):
+    # Send only the decimated shock and fork samples for the visible window of the finished run
+    indexes = lod.window(x0, x1)
+    shock_y, fork_y = lod.channels
+    line_source.data = dict(x=lod.x[indexes], shock=shock_y[indexes], fork=fork_y[indexes])
+
+
+def range_changed(event):
+    if run_lod is not None:
+        update_line(run_lod, event.x0, event.x1)
+
+
+run_complete = False
+run_lod = None
+bike_data = process_bike_data(current_bike_file)
+tail = RunFileTail(current_data_file)
+shock = LiveChannel(bike_data[0], bike_data[1])
+fork = LiveChannel(bike_data[2], bike_data[3])
+line_source = ColumnDataSource(data=dict(x=[], shock=[], fork=[]))
+
+displacement_graph = figure(
+    title=f"Live Displacement Plot: {current_data_file}, {current_bike_file}",
+    sizing_mode="stretch_width",
+    height=450,
+    x_axis_label="Time (s)",
+    y_axis_label="Percentage displacement (%)",
+    tools="pan, reset, wheel_zoom, xwheel_zoom, fullscreen, examine, crosshair",
+)
+displacement_graph.x_range = DataRange1d(follow="end", follow_interval=LIVE_WINDOW, range_padding=0)
+displacement_graph.y_range = Range1d(start=0, end=100, bounds=(0, 100))
+
+displacement_graph.line("x", "fork", source=line_source, legend_label="Front Fork", color="#00FFFF", line_width=0.5)
+displacement_graph.scatter("x", "y", source=fork.peaks, color="red", size=2, legend_label="Fork Peaks", marker="circle")
+displacement_graph.scatter("x", "y", source=fork.troughs, color="orange", size=2, legend_label="Fork Troughs", marker="circle")
+
+displacement_graph.line("x", "shock", source=line_source, legend_label="Rear Shock", color="#FF9500", line_width=0.5)
+displacement_graph.scatter("x", "y", source=shock.peaks, color="red", size=2, legend_label="Shock Peaks", marker="circle")
+displacement_graph.scatter("x", "y", source=shock.troughs, color="orange", size=2, legend_label="Shock Troughs", marker="circle")
+
+displacement_graph.on_event(RangesUpdate, range_changed)
+displacement_graph.toolbar.logo = None
+displacement_graph.legend.click_policy = "hide"
+
+status_div = Div(text=f"<pre>Waiting for {current_data_file}</pre>")
+
+curdoc().theme = "dark_minimal"
+curdoc().add_root(column(displacement_graph, status_div, sizing_mode="stretch_both"))
+poll_callback = curdoc().add_periodic_callback(poll, POLL_PERIOD_MS)
@@ -0,0 +1,128 @@
+# range_stats.py
+# Statistics for any time window of a run without rescanning its samples: built once per run, then each query is
+# two index lookups plus constant work, so a box-select or pan can be answered on every mouse move
+# Mean and bottom-outs come from prefix sums, max/min from a sparse table over blocks, slopes from prefix regression sums,
+# sag (median travel) from prefix travel histograms over blocks
+
+import numpy as np
+from accelerometer_data_processor import RegressionAccumulator, find_displacement_speed, format_data
+from histograms import BOTTOM_OUT_THRESHOLD
+
+BLOCK = 64  # Samples per sparse table and histogram block, partial blocks at the window ends are scanned directly
+SAG_BINS = 101  # 1 % travel bins from 0 to 100, travel outside is counted in the end bins
+
+
+def sparse_table(values, reduce):
+    # Level k holds reduce over 2**k consecutive values starting at each index
+    levels = [values]
+    width = 1
+    while 2 * width <= len(values):
+        previous = levels[-1]
+        levels.append(reduce(previous[:-width], previous[width:]))
+        width *= 2
+    return levels
+
+
+class ChannelIndex:
+    # Window queries over one channel's travel (%) and its compression/rebound events
+    def __init__(self, channel, min_displacement=1):
+        y = np.asarray(channel.values, dtype=np.float64)
+        self.y = y
+        self.sums = np.concatenate(([0.0], np.cumsum(y)))
+
+        blocks = np.pad(y, (0, -len(y) % BLOCK), constant_values=np.nan).reshape(-1, BLOCK)
+        self.maxima = sparse_table(np.nanmax(blocks, axis=1) if len(y) else np.zeros(0), np.maximum)
+        self.minima = sparse_table(np.nanmin(blocks, axis=1) if len(y) else np.zeros(0), np.minimum)
+
+        # Travel bin counts of all whole blocks before each block, so a window's histogram is one difference
+        self.bins = np.clip(np.floor(y), 0, SAG_BINS - 1).astype(np.intp)
+        wholeBlocks = len(y) // BLOCK
+        blockCounts = np.zeros((wholeBlocks, SAG_BINS), dtype=np.int32)
+        np.add.at(blockCounts, (np.arange(wholeBlocks * BLOCK) // BLOCK, self.bins[:wholeBlocks * BLOCK]), 1)
+        self.histograms = np.vstack((np.zeros((1, SAG_BINS), dtype=np.int32), np.cumsum(blockCounts, axis=0, dtype=np.int32)))
+
+        # Entries into the bottom-out zone, a window starting inside the zone counts one more
+        self.bottomedOut = y >= BOTTOM_OUT_THRESHOLD
+        entries = np.concatenate(([False], self.bottomedOut[1:] & ~self.bottomedOut[:-1]))
+        self.entries = np.concatenate(([0], np.cumsum(entries)))
+
+        # Compression runs trough to peak, rebound peak to trough. Events are placed at their starting turning point
+        # Regression sums are of values centred on the mean of all the run's events, so a window's centred sums do not
+        # come from subtracting large raw sums (the cancellation RegressionAccumulator avoids for whole runs)
+        self.events = {}
+        for kind, (a, b, aTimes, bTimes) in {
+            "compression": (channel.troughs, channel.peaks, channel.troughTimes, channel.peakTimes),
+            "rebound": (channel.peaks, channel.troughs, channel.peakTimes, channel.troughTimes),
+        }.items():
+            times, speed, displacement = find_displacement_speed(a, b, aTimes, bTimes, min_displacement)
+            offset = (float(np.mean(displacement)), float(np.mean(speed))) if len(times) else (0.0, 0.0)
+            dx, dy = displacement - offset[0], speed - offset[1]
+            sums = np.column_stack((np.ones(len(times)), dx, dy, dx * dx, dx * dy))
+            self.events[kind] = (times, offset, np.vstack((np.zeros(5), np.cumsum(sums, axis=0))))
+
+    def extreme(self, table, reduce, i0, i1):
+        # reduce over samples i0..i1-1: whole blocks from the sparse table, the partial blocks at each end directly
+        b0, b1 = -(-i0 // BLOCK), i1 // BLOCK
+        if b0 >= b1:
+            return float(reduce.reduce(self.y[i0:i1]))
+        level = (b1 - b0).bit_length() - 1
+        parts = [table[level][b0], table[level][b1 - (1 << level)]]
+        if i0 < b0 * BLOCK:
+            parts.append(reduce.reduce(self.y[i0:b0 * BLOCK]))
+        if b1 * BLOCK < i1:
+            parts.append(reduce.reduce(self.y[b1 * BLOCK:i1]))
+        return float(reduce.reduce(parts))
+
+    def sag(self, i0, i1):
+        # Median travel (%) of samples i0..i1-1 from their 1 % bin counts, interpolated within the median's bin
+        b0, b1 = -(-i0 // BLOCK), i1 // BLOCK
+        if b0 >= b1:
+            counts = np.bincount(self.bins[i0:i1], minlength=SAG_BINS)
+        else:
+            counts = self.histograms[b1] - self.histograms[b0]
+            counts += np.bincount(self.bins[i0:b0 * BLOCK], minlength=SAG_BINS)
+            counts += np.bincount(self.bins[b1 * BLOCK:i1], minlength=SAG_BINS)
+        cumulative = np.cumsum(counts)
+        half = (i1 - i0) / 2
+        median = int(np.searchsorted(cumulative, half))
+        below = cumulative[median] - counts[median]
+        return median + (half - below) / counts[median]
+
+    def regression(self, kind, t0, t1):
+        # Least squares fit of speed against displacement for the events starting in [t0, t1]
+        times, (offsetX, offsetY), sums = self.events[kind]
+        e0, e1 = np.searchsorted(times, t0, side="left"), np.searchsorted(times, t1, side="right")
+        n, sx, sy, sxx, sxy = sums[e1] - sums[e0]
+        if n == 0:
+            return RegressionAccumulator()
+        return RegressionAccumulator(int(n), offsetX + sx / n, offsetY + sy / n, sxx - sx * sx / n, sxy - sx * sy / n)
+
+    def query(self, i0, i1, t0, t1):
+        # [max, min, mean, compression slope, rebound slope] as used by format_data, the bottom-out count and sag
+        if i1 <= i0:
+            return [float("nan")] * 5, 0, float("nan")
+        mean = float(self.sums[i1] - self.sums[i0]) / (i1 - i0)
+        bottomOuts = int(self.entries[i1] - self.entries[i0 + 1] + self.bottomedOut[i0])
+        return [self.extreme(self.maxima, np.maximum, i0, i1), self.extreme(self.minima, np.minimum, i0, i1), mean,
+                self.regression("compression", t0, t1).slope(), self.regression("rebound", t0, t1).slope()], bottomOuts, self.sag(i0, i1)
+
+
+class RunIndex:
+    # Window queries over both channels of a RunResult sharing its time axis
+    def __init__(self, result, min_displacement=1):
+        self.time = result.time
+        self.fork = ChannelIndex(result.fork, min_displacement)
+        self.shock = ChannelIndex(result.shock, min_displacement)
+
+    def query(self, t0, t1):
+        # Returns (shock, fork) results of ChannelIndex.query for the samples between t0 and t1 (s)
+        t0, t1 = min(t0, t1), max(t0, t1)
+        i0, i1 = self.time.searchsorted(t0, side="left"), self.time.searchsorted(t1, side="right")
+        return self.shock.query(i0, i1, t0, t1), self.fork.query(i0, i1, t0, t1)
+
+    def format(self, t0, t1):
+        # Window statistics laid out like format_data, with sag and bottom-outs. Window slopes are always least squares,
+        # Theil-Sen is too slow to answer on every mouse move
+        (shock, shockBottomOuts, shockSag), (fork, forkBottomOuts, forkSag) = self.query(t0, t1)
+        return (f"Window {min(t0, t1):.2f}-{max(t0, t1):.2f} s, least squares slopes\n{format_data(shock, fork)}\n"
+                f"Sag (median):\t\t{round(shockSag, 2)}\t\t{round(forkSag, 2)}\nBottom-outs:\t\t{shockBottomOuts}\t\t{forkBottomOuts}")
@@ -0,0 +1,124 @@
+# robust_regression.py
+# Slope fits of speed against displacement with a 95 % confidence interval: least squares, or Theil-Sen, which one glitched
+# turning point cannot drag. Theil-Sen needs order statistics of all n^2 / 2 pairwise slopes without forming them: the number
+# of slopes below t is the number of inversions of y - t * x in x order (O(n log n)), so each rank is found by k-section on t
+# from a bracket taken off a random sample of pairs
+
+from dataclasses import dataclass
+import numpy as np
+from instrumentation import instrumented
+
+REGRESSION_METHODS = ("ols", "theil-sen")
+Z_95 = 1.959964  # Two-sided 95 % normal quantile
+SAMPLE_PAIRS = 4096  # Random pairs used to bracket each rank before counting
+PROBES = 8  # Sub-intervals per k-section step, each step shrinks a bracket 8 times for one batched count
+TOLERANCE = 1e-7  # Relative width at which a bracketed slope is taken as found, far below the displayed precision
+
+
+@dataclass(slots=True)
+class SlopeFit:
+    # Fitted line and the 95 % confidence interval of its slope, NaN when there are too few points
+    slope: float
+    intercept: float
+    low: float
+    high: float
+    method: str  # One of REGRESSION_METHODS
+
+    @classmethod
+    def empty(cls, method):
+        return cls(float("nan"), float("nan"), float("nan"), float("nan"), method)
+
+    def interval(self):
+        return self.low, self.high
+
+
+def ols_fit(accumulator, x=None, y=None):
+    # Least squares line from a RegressionAccumulator over x, y. Interval from the slope's standard error (normal approximation)
+    # Without the points the residual sum of squares comes from the accumulator's centred sums
+    slope, intercept = accumulator.slope(), accumulator.intercept()
+    if accumulator.n < 3 or np.isnan(slope):
+        return SlopeFit(slope, intercept, float("nan"), float("nan"), "ols")
+    if x is None:
+        residualSquares = max(accumulator.syy - slope * accumulator.sxy, 0.0)
+    else:
+        residuals = np.asarray(y, dtype=np.float64) - (slope * np.asarray(x, dtype=np.float64) + intercept)
+        residualSquares = np.dot(residuals, residuals)
+    error = Z_95 * np.sqrt(residualSquares / (accumulator.n - 2) / accumulator.sxx)
+    return SlopeFit(slope, intercept, float(slope - error), float(slope + error), "ols")
+
+
+def count_inversions(values):
+    # Pairs i < j with values[i] > values[j] in each row of values, by bottom-up merge sort. Equal values are not inversions
+    # Keys carry the row and merge group above the value, so every row and group is merged in one stable argsort per level.
+    # A right-half element passing m larger left-half elements moves m places back, so a level's inversions are those moves
+    rows, n = values.shape
+    values = np.argsort(values, axis=1, kind="stable")  # Inverse permutation of the ranks, same inversions, ties never invert
+    counts = np.zeros(rows, dtype=np.int64)
+    position = np.arange(n)
+    width = 1
+    while width < n:
+        group = position // (2 * width)
+        offset = (np.arange(rows)[:, None] * (group[-1] + 1) + group) * n
+        right = (position // width) % 2 == 1
+        order = np.argsort(values + offset, axis=1, kind="stable")  # Timsort merges the two sorted runs of each group
+        counts += position[right].sum() - (position * right[order]).sum(axis=1)
+        values = np.take_along_axis(values, order, axis=1)
+        width *= 2
+    return counts
+
+
+def count_slopes_below(x, y, t):
+    # Number of pairs with slope < t for every t, points sorted by x then y so pairs with equal x (no slope) never invert
+    return count_inversions(y[None, :] - np.asarray(t)[:, None] * x[None, :])
+
+
+def select_slopes(x, y, ranks, pairs):
+    # Slopes of the given 0-based ranks among the pairs pairwise slopes, points sorted by x then y
+    ranks = np.asarray(ranks, dtype=np.int64)
+    gaps = np.diff(x)
+    bound = (y.max() - y.min()) / gaps[gaps > 0].min() + 1  # Every slope lies strictly inside (-bound, bound)
+
+    # Bracket each rank from the sorted slopes of random pairs, a few standard errors either side of its quantile
+    rng = np.random.default_rng(0)
+    i, j = rng.integers(0, len(x), (2, SAMPLE_PAIRS))
+    valid = x[i] != x[j]
+    sample = np.sort((y[j[valid]] - y[i[valid]]) / (x[j[valid]] - x[i[valid]]))
+    quantile = (ranks + 0.5) / pairs
+    spread = 3 * np.sqrt(len(sample) * quantile * (1 - quantile)) + 1
+    below, above = np.floor(quantile * len(sample) - spread).astype(int), np.ceil(quantile * len(sample) + spread).astype(int)
+    low = np.where(below >= 0, sample[np.clip(below, 0, max(len(sample) - 1, 0))] if len(sample) else -bound, -bound)
+    high = np.where(above < len(sample), sample[np.clip(above, 0, max(len(sample) - 1, 0))] if len(sample) else bound, bound)
+    counts = count_slopes_below(x, y, np.concatenate((low, high)))
+    low = np.where(counts[:len(ranks)] <= ranks, low, -bound)  # Invariant: count(low) <= rank < count(high)
+    high = np.where(counts[len(ranks):] > ranks, high, bound)
+
+    steps = np.arange(1, PROBES) / PROBES
+    while np.any(high - low > TOLERANCE * np.maximum(1, np.maximum(np.abs(low), np.abs(high)))):
+        probes = low[:, None] + (high - low)[:, None] * steps
+        counts = count_slopes_below(x, y, probes.ravel()).reshape(probes.shape)
+        below = counts <= ranks[:, None]
+        lastBelow = below.sum(axis=1)  # Counts grow with t, so the probes at or below each rank come first
+        low = np.where(lastBelow > 0, probes[np.arange(len(ranks)), np.maximum(lastBelow - 1, 0)], low)
+        high = np.where(lastBelow < PROBES - 1, probes[np.arange(len(ranks)), np.minimum(lastBelow, PROBES - 2)], high)
+    return (low + high) / 2
+
+
+@instrumented("theil-sen", samples=lambda args, result: len(args[0]))
+def theil_sen(x, y):
+    # Median pairwise slope with Sen's rank-based 95 % interval, intercept is the median of y - slope * x
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    order = np.lexsort((y, x))
+    x, y = x[order], y[order]
+    n = len(x)
+    _, ties = np.unique(x, return_counts=True)
+    pairs = n * (n - 1) // 2 - int((ties * (ties - 1) // 2).sum())
+    if pairs == 0:
+        return SlopeFit.empty("theil-sen")
+
+    spread = Z_95 * np.sqrt(n * (n - 1) * (2 * n + 5) / 18)
+    lower = min(max(int(round((pairs - spread) / 2)) - 1, 0), pairs - 1)
+    upper = min(max(int(round((pairs + spread) / 2)), 0), pairs - 1)
+    ranks, positions = np.unique([lower, (pairs - 1) // 2, pairs // 2, upper], return_inverse=True)  # Odd pairs: one median
+    low, medianLow, medianHigh, high = select_slopes(x, y, ranks, pairs)[positions]
+    slope = (medianLow + medianHigh) / 2
+    return SlopeFit(float(slope), float(np.median(y - slope * x)), float(low), float(high), "theil-sen")
@@ -0,0 +1,155 @@
+# run_cache.py
+# Two-tier run cache: raw ADC arrays per file content, and processed results per (run, bike profile, parameters)
+# A bike switch only rescales cached raw arrays, a repeat selection is a straight hit
+# Uploads are parsed from memory and keyed by the same content hash, saving them to disk is optional. Text and binary runs both work
+
+from accelerometer_data_processor import parse_run_content, process_raw_run, process_runs
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+from run_format import EXTENSION, TEXT_EXTENSION, is_binary_run
+
+RAW_BUDGET_BYTES = 256 * 1024 * 1024
+RESULT_BUDGET_BYTES = 256 * 1024 * 1024
+UPLOAD_FOLDER = "run_data"
+
+
+def size_of(value):
+    # Approximate memory held by a cached entry
+    if hasattr(value, "nbytes"):  # Arrays and processed runs report their own footprint
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(size_of(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(size_of(item) for item in value) + 8 * len(value)
+    if isinstance(value, str):
+        return len(value)
+    return 64
+
+
+class LRUCache:
+    # Least recently used eviction bounded by the approximate bytes held
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.bytes = 0
+        self.lock = threading.Lock()  # Worker threads of every session share the cache
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value):
+        size = size_of(value)
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.budget_bytes and len(self.entries) > 1:
+                self.bytes -= self.entries.popitem(last=False)[1][1]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+class RunCache:
+    def __init__(self, raw_budget_bytes=RAW_BUDGET_BYTES, result_budget_bytes=RESULT_BUDGET_BYTES):
+        self.raw_runs = LRUCache(raw_budget_bytes)  # digest -> (header, initialValues, shock, fork, timeOfRun, accel, channels)
+        self.results = LRUCache(result_budget_bytes)  # (digest, bike, min_displacement, regression) -> RunResult
+        self.file_digests = {}  # path -> (mtime_ns, size, digest), so unchanged files are not re-hashed
+
+    def digest(self, path, content=None):
+        # Content hash of a run file, recomputed only when its mtime or size changes
+        stat = os.stat(path)
+        known = self.file_digests.get(path)
+        if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+            return known[2]
+        if content is None:
+            with open(path, "rb") as f:
+                content = f.read()
+        digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+        self.file_digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def raw(self, path):
+        # Returns (digest, raw run) reading and parsing the file only on a miss
+        known = self.file_digests.get(path)
+        stat = os.stat(path)
+        if known and known[:2] == (stat.st_mtime_ns, stat.st_size) and known[2] in self.raw_runs:
+            return known[2], self.raw_runs.get(known[2])
+        with open(path, "rb") as f:
+            content = f.read()
+        digest = self.digest(path, content)
+        raw = self.raw_runs.get(digest)
+        if raw is None:
+            raw = parse_run_content(content)
+            self.raw_runs.put(digest, raw)
+        return digest, raw
+
+    def result(self, path, bike_data, min_displacement=1, regression="ols"):
+        # Processed run for a bike profile, None when the file does not exist
+        if not os.path.exists(path):
+            print(f"File '{path}' not found")
+            return None
+        key = (self.digest(path), tuple(bike_data), min_displacement, regression)
+        data = self.results.get(key)
+        if data is None:
+            digest, (header, initialValues, shock, fork, timeOfRun, accel, channels) = self.raw(path)
+            data = process_raw_run(shock, fork, timeOfRun, bike_data, min_displacement, accel, header, regression, channels)
+            self.results.put(key, data)
+        return data
+
+    def upload(self, content):
+        # Parses uploaded bytes without touching disk. Returns (digest, raw run), an identical upload is not parsed again
+        digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+        raw = self.raw_runs.get(digest)
+        if raw is None:
+            raw = parse_run_content(content)
+            self.raw_runs.put(digest, raw)
+        return digest, raw
+
+    def upload_result(self, digest, raw, bike_data, min_displacement=1, regression="ols"):
+        # Processed upload for a bike profile. The session holds the raw run so it survives eviction from raw_runs
+        key = (digest, tuple(bike_data), min_displacement, regression)
+        data = self.results.get(key)
+        if data is None:
+            header, initialValues, shock, fork, timeOfRun, accel, channels = raw
+            data = process_raw_run(shock, fork, timeOfRun, bike_data, min_displacement, accel, header, regression, channels)
+            self.results.put(key, data)
+        return data
+
+    def save_upload(self, digest, content, folder=UPLOAD_FOLDER):
+        # Writes an upload to the run folder under its content hash. Returns the path of an identical run if one is already there
+        for path, (mtime_ns, size, known) in list(self.file_digests.items()):
+            if known == digest and os.path.exists(path):
+                return path
+        path = os.path.join(folder, f"upload_{digest}{EXTENSION if is_binary_run(content) else TEXT_EXTENSION}")
+        if not os.path.exists(path):
+            temp_path = f"{path}.{os.getpid()}.tmp"  # Written aside and renamed, so sessions never see half a file
+            with open(temp_path, "wb") as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        stat = os.stat(path)
+        self.file_digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return path
+
+    def results_for(self, paths, bike_data, min_displacement=1, workers=None, regression="ols"):
+        # Processed runs for several files. Runs with nothing cached are parsed and processed in parallel worker processes,
+        # which send back the raw arrays too, so a later bike switch only rescales them
+        existing = [path for path in paths if os.path.exists(path)]
+        keys = {path: (self.digest(path), tuple(bike_data), min_displacement, regression) for path in existing}
+        cold = list(dict.fromkeys(path for path in existing if keys[path] not in self.results and keys[path][0] not in self.raw_runs))
+        if len(cold) > 1:
+            for path, (raw, data) in zip(cold, process_runs(cold, bike_data, min_displacement, workers, regression, raw=True)):
+                self.raw_runs.put(keys[path][0], raw)
+                self.results.put(keys[path], data)
+        return [self.result(path, bike_data, min_displacement, regression) for path in paths]
+
+
+# Shared by every session of a Bokeh server process
+run_cache = RunCache()
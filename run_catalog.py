@@ -0,0 +1,215 @@
+# run_catalog.py
+# Persistent SQLite catalog of run files: content hash, duration, sample count, header rates and per bike profile summary statistics
+# Refreshed incrementally (only new or changed files are read) and queried through indexes, so thousands of runs stay fast
+# Usage: python run_catalog.py run_data --bike bike_profiles/wills_megatower.txt --min-duration 40 --sort fork_compression_slope
+
+from contextlib import closing
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+from spectral import header_rates
+from run_format import RUN_EXTENSIONS, BinaryRun, is_binary_run, run_files
+
+CATALOG_PATH = "run_catalog.sqlite"
+SUMMARY_COLUMNS = [
+    "fork_max", "fork_min", "fork_mean", "shock_max", "shock_min", "shock_mean",
+    "fork_compression_slope", "fork_rebound_slope", "shock_compression_slope", "shock_rebound_slope",
+    "fork_bottom_outs", "shock_bottom_outs",
+]
+RUN_COLUMNS = ["path", "name", "digest", "duration", "samples", "rates"]
+SORT_COLUMNS = set(RUN_COLUMNS + SUMMARY_COLUMNS + ["mtime_ns", "size"])
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    path TEXT PRIMARY KEY, name TEXT, folder TEXT, mtime_ns INTEGER, size INTEGER, digest TEXT,
+    header TEXT, rates TEXT, duration REAL, samples INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_folder_duration ON runs (folder, duration);
+CREATE INDEX IF NOT EXISTS runs_digest ON runs (digest);
+CREATE TABLE IF NOT EXISTS summaries (
+    digest TEXT, bike TEXT, bike_values TEXT, min_displacement REAL,
+    {", ".join(f"{column} {'INTEGER' if column.endswith('bottom_outs') else 'REAL'}" for column in SUMMARY_COLUMNS)},
+    fork_histogram TEXT, shock_histogram TEXT,
+    PRIMARY KEY (digest, bike, min_displacement)
+);
+CREATE INDEX IF NOT EXISTS summaries_bike_fork_compression ON summaries (bike, fork_compression_slope);
+CREATE INDEX IF NOT EXISTS summaries_bike_shock_compression ON summaries (bike, shock_compression_slope);
+"""
+
+
+def scan_run(path):
+    # Content hash, header, sample count and duration of a run without parsing its data rows
+    with open(path, "rb") as f:
+        content = f.read()
+    digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+    if is_binary_run(content):
+        run = BinaryRun(content)
+        return digest, run.header, len(run), run.timeOfRun
+    lines = content.split(b"\n")
+    header = lines[0].rstrip(b"\r").decode("utf-8", "replace")
+    duration = 0.0
+    for line in reversed(lines[2:]):
+        line = line.strip()
+        if line.isdigit():
+            duration = int(line) / 1000
+            break
+        if b"," in line:
+            break
+    samples = sum(1 for line in lines[2:] if b"," in line)
+    return digest, header, samples, duration
+
+
+def summary_values(result):
+    # Summary statistics of a processed RunResult in SUMMARY_COLUMNS order, histograms as JSON text
+    values = []
+    for channel in ["fork", "shock"]:
+        data = result.channel(channel)
+        values += [float(data.maximum), float(data.minimum), float(data.mean)]
+    for channel in ["fork", "shock"]:
+        data = result.channel(channel)
+        values += [data.compression.slope(), data.rebound.slope()]
+    values += [result.fork.histogram.bottomOuts, result.shock.histogram.bottomOuts]
+    histograms = [json.dumps(result.channel(channel).histogram.to_dict(), separators=(",", ":")) for channel in ["fork", "shock"]]
+    return values + histograms
+
+
+def run_label(row):
+    # Menu text for a catalogued run
+    return f"{row['name']} ({row['duration']:.0f} s)"
+
+
+def like_escape(text):
+    # text matched literally by LIKE ... ESCAPE '\', e.g. the underscore in "test_run"
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class RunCatalog:
+    # One short-lived connection per call, so sessions, worker threads and processes can share the catalog file
+    def __init__(self, path=CATALOG_PATH):
+        self.path = path
+        with closing(self.connect()) as connection, connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def refresh(self, folder):
+        # Brings the catalog in line with the run files in folder. Only new or changed files are read, returns their paths
+        files = {}
+        if os.path.isdir(folder):
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.lower().endswith(RUN_EXTENSIONS):
+                        stat = entry.stat()
+                        files[os.path.join(folder, entry.name)] = (stat.st_mtime_ns, stat.st_size)
+            files = {path: files[path] for path in run_files(files)}  # A converted run is catalogued once, by its binary file
+
+        with closing(self.connect()) as connection, connection:
+            known = {row["path"]: (row["mtime_ns"], row["size"])
+                     for row in connection.execute("SELECT path, mtime_ns, size FROM runs WHERE folder = ?", (folder,))}
+            removed = [(path,) for path in known if path not in files]
+            changed = [path for path, stat in files.items() if known.get(path) != stat]
+            rows = []
+            for path in changed:
+                digest, header, samples, duration = scan_run(path)
+                rows.append((path, os.path.basename(path), folder, *files[path], digest, header, json.dumps(header_rates(header)), duration, samples))
+            connection.executemany("DELETE FROM runs WHERE path = ?", removed)
+            connection.executemany("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return changed
+
+    def record_summary(self, path, bike_file, bike_data, result, min_displacement=1):
+        # Stores the summary statistics of a processed run for a bike profile. Runs that are not catalogued are ignored
+        with closing(self.connect()) as connection, connection:
+            row = connection.execute("SELECT digest FROM runs WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                return False
+            connection.execute(
+                f"INSERT OR REPLACE INTO summaries VALUES ({', '.join('?' * (4 + len(SUMMARY_COLUMNS) + 2))})",
+                (row["digest"], os.path.basename(bike_file), " ".join(str(value) for value in bike_data), min_displacement,
+                 *summary_values(result)))
+        return True
+
+    def missing_summaries(self, folder, bike_file, bike_data, min_displacement=1):
+        # Paths in folder with no summary for the bike profile, or one made with different calibration values
+        with closing(self.connect()) as connection:
+            return [row["path"] for row in connection.execute(
+                "SELECT runs.path FROM runs LEFT JOIN summaries ON summaries.digest = runs.digest AND summaries.bike = ? "
+                "AND summaries.min_displacement = ? AND summaries.bike_values = ? WHERE runs.folder = ? AND summaries.digest IS NULL",
+                (os.path.basename(bike_file), min_displacement, " ".join(str(value) for value in bike_data), folder))]
+
+    def summarise_missing(self, folder, bike_file, min_displacement=1, workers=None):
+        # Processes runs missing a summary for the bike profile across worker processes, returns how many were added
+        from accelerometer_data_processor import process_bike_data, process_runs  # Processing is only needed here
+        bike_data = process_bike_data(bike_file)
+        paths = self.missing_summaries(folder, bike_file, bike_data, min_displacement)
+        for path, result in zip(paths, process_runs(paths, bike_data, min_displacement, workers)):
+            self.record_summary(path, bike_file, bike_data, result, min_displacement)
+        return len(paths)
+
+    def query(self, folder=None, bike_file=None, min_duration=None, max_duration=None, name=None,
+              sort="name", descending=False, limit=None, min_displacement=1):
+        # Catalogued runs as dicts. With bike_file only runs summarised for that profile are returned, with their statistics
+        if sort not in SORT_COLUMNS:
+            raise ValueError(f"Cannot sort by '{sort}', choose one of {sorted(SORT_COLUMNS)}")
+        if sort in SUMMARY_COLUMNS and bike_file is None:
+            raise ValueError(f"Sorting by '{sort}' needs a bike profile, summaries are kept per bike")
+        table = "summaries" if sort in SUMMARY_COLUMNS else "runs"
+        columns = ", ".join(f"runs.{column}" for column in RUN_COLUMNS + ([sort] if table == "runs" and sort not in RUN_COLUMNS else []))
+        sql = f"SELECT {columns} FROM runs"
+        conditions, parameters = [], []
+        if bike_file is not None:
+            sql = f"SELECT {columns}, {', '.join(f'summaries.{column}' for column in SUMMARY_COLUMNS)} FROM runs " \
+                  "JOIN summaries ON summaries.digest = runs.digest"
+            conditions += ["summaries.bike = ?", "summaries.min_displacement = ?"]
+            parameters += [os.path.basename(bike_file), min_displacement]
+        for condition, value in [("runs.folder = ?", folder), ("runs.duration >= ?", min_duration),
+                                 ("runs.duration <= ?", max_duration), ("runs.name LIKE ? ESCAPE '\\'", name and f"%{like_escape(name)}%")]:
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {table}.{sort} {'DESC' if descending else 'ASC'}, runs.path"
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(int(limit))
+        with closing(self.connect()) as connection:
+            return [dict(row) for row in connection.execute(sql, parameters)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh the run catalog and list runs matching a query")
+    parser.add_argument("folder", help="Folder of run files, e.g. run_data")
+    parser.add_argument("--bike", help="Bike profile, summarises any run not yet catalogued for it and adds its statistics")
+    parser.add_argument("--min-duration", type=float, help="Shortest run (s)")
+    parser.add_argument("--max-duration", type=float, help="Longest run (s)")
+    parser.add_argument("--name", help="Part of the file name")
+    parser.add_argument("--sort", default="name", help="Column to sort by, e.g. fork_compression_slope")
+    parser.add_argument("--descending", action="store_true")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--catalog", default=CATALOG_PATH, help="Catalog file")
+    args = parser.parse_args()
+
+    catalog = RunCatalog(args.catalog)
+    changed = catalog.refresh(args.folder)
+    added = catalog.summarise_missing(args.folder, args.bike) if args.bike else 0
+    print(f"{len(changed)} runs scanned, {added} summarised")
+    columns = ["name", "duration", "samples"] + ([args.sort] if args.sort not in ("name", "duration", "samples") else [])
+    if args.bike:
+        columns += [column for column in ["fork_compression_slope", "shock_compression_slope", "fork_bottom_outs"] if column not in columns]
+    try:
+        rows = catalog.query(args.folder, args.bike, args.min_duration, args.max_duration, args.name, args.sort, args.descending, args.limit)
+    except ValueError as error:
+        parser.error(str(error))
+    print("\t".join(columns))
+    for row in rows:
+        print("\t".join(f"{row[column]:.2f}" if isinstance(row[column], float) else str(row[column]) for column in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+# run_format.py
+# Compact binary run format, 32 bytes a row against about 50 as text, read without tokenising or float parsing
+# Layout, all little-endian:
+#   8 bytes  MAGIC
+#   uint16   format VERSION, uint16 reserved (0), uint32 metadata length in bytes
+#   metadata UTF-8 JSON: header and initial values lines, footer lines, text layout and one {name, dtype, decimals} per column,
+#            zero padded so the records start on an 8-byte boundary
+#   records  one packed row per logged row: float32 (<f4) IMU columns, int16 (<i2) ADC columns, until the end of the file
+# The row count comes from the file size, so a logger can append records and write the footer metadata last
+# Usage: python run_format.py run_data [--output run_binary]  (converts every text run, unchanged ones are skipped)
+
+import argparse
+import json
+import os
+import struct
+import numpy as np
+from run_schema import ACCEL_COLUMNS, IMU_COLUMNS, RunSchema
+
+MAGIC = b"SDRUN\x00\x00\x00"
+VERSION = 1
+PREAMBLE = struct.Struct("<8sHHI")
+EXTENSION = ".sdr"
+TEXT_EXTENSION = ".txt"
+RUN_EXTENSIONS = (TEXT_EXTENSION, EXTENSION)  # Files treated as runs when listing a folder
+IMU_NAMES = ("ax", "ay", "az", "gx", "gy", "gz")
+INT16_RANGE = (-32768, 32767)
+
+
+def is_binary_run(content):
+    # True for the bytes (or first bytes) of a binary run
+    return bytes(content[:len(MAGIC)]) == MAGIC
+
+
+def run_files(paths):
+    # The run files among paths, one per run: where a text run was converted beside itself only the newer of the pair is
+    # kept, the binary form unless the text has changed since
+    runs = [path for path in paths if path.lower().endswith(RUN_EXTENSIONS)]
+    texts = {os.path.splitext(path)[0]: path for path in runs if not path.lower().endswith(EXTENSION)}
+    hidden = set()
+    for path in runs:
+        source = texts.get(os.path.splitext(path)[0]) if path.lower().endswith(EXTENSION) else None
+        if source is not None:
+            hidden.add(source if os.path.getmtime(path) >= os.path.getmtime(source) else path)
+    return [path for path in runs if path not in hidden]
+
+
+def footer_time(footer):
+    # Run time (s) from the footer lines, the last line holding the milliseconds logged, 0 when missing
+    timeOfRun = 0
+    for line in footer:
+        if line.strip() and line != "Run finished":
+            timeOfRun = int(line) / 1000
+    return timeOfRun
+
+
+class BinaryRun:
+    # Zero-copy NumPy views of a binary run held in any buffer: bytes, or a memory map of the file from open()
+    def __init__(self, buffer):
+        magic, version, _, length = PREAMBLE.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a binary run")
+        if version > VERSION:
+            raise ValueError(f"Binary run version {version} is newer than this reader ({VERSION})")
+        self.metadata = json.loads(bytes(buffer[PREAMBLE.size:PREAMBLE.size + length]).decode("utf-8"))
+        self.dataOffset = -(-(PREAMBLE.size + length) // 8) * 8
+        self.dtype = np.dtype([(column["name"], column["dtype"]) for column in self.metadata["columns"]])
+        rows = (len(buffer) - self.dataOffset) // self.dtype.itemsize
+        self.buffer = buffer
+        self.records = np.frombuffer(buffer, dtype=self.dtype, count=rows, offset=self.dataOffset) if rows else np.zeros(0, self.dtype)
+        self.schema = RunSchema.from_header(self.header)
+
+    @classmethod
+    def open(cls, path):
+        return cls(np.memmap(path, dtype=np.uint8, mode="r"))
+
+    @property
+    def header(self):
+        return self.metadata["header"]
+
+    @property
+    def initialValues(self):
+        return self.metadata["initialValues"].split(",")
+
+    @property
+    def timeOfRun(self):
+        return footer_time(self.metadata["footer"])
+
+    def __len__(self):
+        return len(self.records)
+
+    def column(self, name):
+        # One column of every row, a strided view of the records
+        return self.records[name]
+
+    def channel(self, code):
+        # A header channel at its own rate: every decimation-th row, still a view
+        return self.records[code][::self.schema.channel(code).decimation]
+
+    @property
+    def accel(self):
+        # Chassis acceleration (rows x 3, m/s^2) as one strided float32 view over the x, y, z columns
+        names = [IMU_NAMES[i] for i in ACCEL_COLUMNS]
+        offsets = [self.dtype.fields[name][1] for name in names]
+        if len(self.records) and all(self.dtype[name] == np.dtype("<f4") for name in names) and offsets == list(range(offsets[0], offsets[0] + 12, 4)):
+            return np.ndarray((len(self.records), 3), dtype="<f4", buffer=self.buffer, offset=self.dataOffset + offsets[0],
+                              strides=(self.dtype.itemsize, 4))
+        return np.column_stack([self.records[name].astype(np.float32) for name in names])
+
+    def text(self):
+        # The text run this was converted from, byte for byte
+        newline = self.metadata["newline"]
+        columns = []
+        for column in self.metadata["columns"]:
+            values = self.records[column["name"]]
+            columns.append(np.char.mod(f"%.{column['decimals']}f", values.astype(np.float64)) if column["decimals"] else values.astype(np.int64).astype(str))
+        rows = [",".join(row) for row in zip(*columns)]
+        lines = [self.header, self.metadata["initialValues"]] + rows + self.metadata["footer"]
+        return newline.join(lines) + (newline if self.metadata["finalNewline"] else "")
+
+
+def text_to_binary(text):
+    # Binary run bytes for the text of a run. Raises ValueError when the binary form would not give back the same text
+    newline = "\r\n" if "\r\n" in text[:4096] else "\n"
+    finalNewline = text.endswith(newline)
+    lines = (text[:-len(newline)] if finalNewline else text).split(newline)
+    lines += [""] * (2 - len(lines))
+    header, initialValues, body = lines[0], lines[1], lines[2:]
+    dataEnd = len(body)
+    while dataEnd > 0 and "," not in body[dataEnd - 1]:
+        dataEnd -= 1
+    rows, footer = body[:dataEnd], body[dataEnd:]
+
+    schema = RunSchema.from_header(header)
+    width = rows[0].count(",") + 1 if rows else IMU_COLUMNS + len(schema.channels)
+    if width < max(channel.column for channel in schema.channels) + 1:
+        raise ValueError(f"Rows have {width} columns, the header needs {max(channel.column for channel in schema.channels) + 1}")
+    names = {channel.column: channel.code for channel in schema.channels} | dict(enumerate(IMU_NAMES))
+    values = np.loadtxt(rows, delimiter=",", dtype=np.float64, ndmin=2) if rows else np.zeros((0, width))
+
+    columns = []
+    for i, token in enumerate(rows[0].split(",") if rows else ["0"] * width):
+        token = token.strip()
+        decimals = len(token) - token.index(".") - 1 if "." in token else 0
+        column = values[:, i]
+        integral = np.all(column == np.round(column)) and not np.any(np.signbit(column) & (column == 0))
+        in_range = not len(column) or (INT16_RANGE[0] <= column.min() and column.max() <= INT16_RANGE[1])
+        dtype = "<i2" if i >= IMU_COLUMNS and integral and in_range else "<f4"
+        columns.append({"name": names.get(i, f"c{i}"), "dtype": dtype, "decimals": decimals})
+
+    metadata = json.dumps({"header": header, "initialValues": initialValues, "footer": footer, "newline": newline,
+                           "finalNewline": finalNewline, "columns": columns}, separators=(",", ":")).encode("utf-8")
+    records = np.zeros(len(rows), dtype=np.dtype([(column["name"], column["dtype"]) for column in columns]))
+    for i, column in enumerate(columns):
+        records[column["name"]] = values[:, i]
+    padding = b"\0" * (-(PREAMBLE.size + len(metadata)) % 8)
+    content = PREAMBLE.pack(MAGIC, VERSION, 0, len(metadata)) + metadata + padding + records.tobytes()
+
+    if BinaryRun(content).text() != text:
+        raise ValueError("Run text does not survive conversion, e.g. mixed decimal places within a column")
+    return content
+
+
+def convert_file(source, output_folder=None):
+    # Writes the binary form of a text run beside it (or into output_folder). Returns (target, text bytes, binary bytes)
+    # A target newer than its source is left as it is
+    folder = output_folder or os.path.dirname(source)
+    target = os.path.join(folder, os.path.splitext(os.path.basename(source))[0] + EXTENSION)
+    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+        return target, os.path.getsize(source), os.path.getsize(target)
+    with open(source, "r", newline="") as f:
+        content = text_to_binary(f.read())
+    os.makedirs(folder, exist_ok=True)
+    temp_path = f"{target}.{os.getpid()}.tmp"  # Written aside and renamed, so readers never see half a file
+    with open(temp_path, "wb") as f:
+        f.write(content)
+    os.replace(temp_path, target)
+    return target, os.path.getsize(source), len(content)
+
+
+def convert_checked(source, output_folder):
+    # convert_file for the worker pool, a failure is reported instead of stopping the batch
+    try:
+        return source, convert_file(source, output_folder), None
+    except (ValueError, OSError) as error:
+        return source, None, str(error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert text runs into the binary run format, verified lossless")
+    parser.add_argument("sources", nargs="+", help="Run files or folders of them")
+    parser.add_argument("--output", help="Folder for the binary runs, default beside each source")
+    parser.add_argument("--workers", type=int, help="Worker processes, default one per core")
+    args = parser.parse_args()
+
+    files = []
+    for source in args.sources:
+        if os.path.isdir(source):
+            files += sorted(os.path.join(source, name) for name in os.listdir(source) if name.lower().endswith(TEXT_EXTENSION))
+        else:
+            files.append(source)
+
+    from concurrent.futures import ProcessPoolExecutor  # Imported here, the core imports this module and must start quickly
+    text_total = binary_total = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for source, converted, error in executor.map(convert_checked, files, [args.output] * len(files)):
+            if error:
+                print(f"{source}: not converted, {error}")
+                continue
+            target, text_bytes, binary_bytes = converted
+            text_total += text_bytes
+            binary_total += binary_bytes
+            print(f"{source} -> {target}\t{text_bytes / 1024:.0f} KiB -> {binary_bytes / 1024:.0f} KiB")
+    print(f"{text_total / 1024:.0f} KiB of text in {binary_total / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
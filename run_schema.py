@@ -0,0 +1,122 @@
+# run_schema.py
+# Channel layout of a run from its header, e.g. "RS:1000:rear_sus,FS:1000:front_sus,RB:250:test2,FB:250:test3"
+# Header channels follow the six IMU columns in header order. A channel slower than the fastest one keeps one sample per rate
+# ratio of rows, and every time axis is a start and a step, materialised only when a consumer asks for its values
+
+from dataclasses import dataclass
+import numpy as np
+
+IMU_COLUMNS = 6  # Chassis acceleration x, y, z (m/s^2) then gyro x, y, z come before the header channels
+ACCEL_COLUMNS = (0, 1, 2)
+DEFAULT_HEADER = "RS:1000:rear_sus,FS:1000:front_sus"  # Layout assumed when a header lists no channels
+SHOCK, FORK = "RS", "FS"  # Travel channels, analysed on the row time axis
+
+
+@dataclass(frozen=True, slots=True)
+class ChannelSpec:
+    code: str  # e.g. "RS"
+    rate: int  # Nominal sample rate from the header (Hz)
+    name: str  # e.g. "rear_sus"
+    column: int  # Column in the data rows
+    decimation: int  # Rows per sample of this channel: the fastest header rate over this one's
+
+
+@dataclass(frozen=True, slots=True)
+class TimeAxis:
+    # Evenly spaced sample times start + i * step for i < count, without storing them
+    start: float
+    step: float
+    count: int
+
+    @classmethod
+    def for_run(cls, count, timeOfRun, decimation=1):
+        # Times of every decimation-th of count rows spread evenly over the run
+        if count == 0:
+            return cls(0.0, 0.0, 0)
+        return cls(0.0, timeOfRun / count * decimation, -(-count // decimation))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        # Times at integer indexes, as the materialised axis would give them
+        return self.start + np.asarray(index) * self.step
+
+    @property
+    def end(self):
+        return self.start + self.count * self.step
+
+    @property
+    def nbytes(self):
+        return 24
+
+    def values(self):
+        # Materialised times (s), float64
+        return self.start + np.arange(self.count) * self.step
+
+    def searchsorted(self, t, side="left"):
+        # As np.searchsorted on values(), by arithmetic instead of a binary search
+        if self.count == 0 or self.step <= 0:
+            return 0 if self.count == 0 or (t <= self.start if side == "left" else t < self.start) else self.count
+        index = int(np.clip(np.ceil((t - self.start) / self.step), 0, self.count))
+        passed = (lambda i: self[i] < t) if side == "left" else (lambda i: self[i] <= t)
+        while index > 0 and not passed(index - 1):  # Step past rounding in the estimate
+            index -= 1
+        while index < self.count and passed(index):
+            index += 1
+        return index
+
+
+@dataclass(slots=True)
+class SampledChannel:
+    # Raw samples of one header channel at its own rate
+    spec: ChannelSpec
+    values: np.ndarray
+    time: TimeAxis
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.time.nbytes
+
+
+def parse_header(header):
+    # ChannelSpecs of the "CODE:RATE:NAME" fields of a header in order, fields without a numeric rate are skipped
+    fields = []
+    for position, field in enumerate(header.split(",")):
+        parts = [part.strip() for part in field.split(":")]
+        if len(parts) >= 2 and parts[1].isdigit() and int(parts[1]) > 0:
+            fields.append((parts[0], int(parts[1]), parts[2] if len(parts) > 2 else parts[0], IMU_COLUMNS + position))
+    fastest = max((rate for _, rate, _, _ in fields), default=1)
+    return tuple(ChannelSpec(code, rate, name, column, max(round(fastest / rate), 1)) for code, rate, name, column in fields)
+
+
+@dataclass(frozen=True, slots=True)
+class RunSchema:
+    channels: tuple  # ChannelSpec per header channel
+
+    @classmethod
+    def from_header(cls, header):
+        channels = parse_header(header)
+        if not any(channel.code == SHOCK for channel in channels) or not any(channel.code == FORK for channel in channels):
+            channels = parse_header(DEFAULT_HEADER)
+        return cls(channels)
+
+    def channel(self, code):
+        return next(channel for channel in self.channels if channel.code == code)
+
+    @property
+    def rates(self):
+        return {channel.code: channel.rate for channel in self.channels}
+
+    @property
+    def travel_columns(self):
+        # Data columns of the shock and fork ADC readings
+        return self.channel(SHOCK).column, self.channel(FORK).column
+
+    @property
+    def other_channels(self):
+        # Header channels besides shock and fork travel
+        return [channel for channel in self.channels if channel.code not in (SHOCK, FORK)]
+
+
+DEFAULT_SCHEMA = RunSchema.from_header(DEFAULT_HEADER)
@@ -0,0 +1,69 @@
+# spectral.py
+# Frequency content of a run: Welch power spectral density of fork/shock travel and chassis acceleration, numpy only
+# Every channel goes through one batched FFT, in blocks of segments so multi-hour logs stay within a bounded working set
+
+from dataclasses import dataclass
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from instrumentation import instrumented
+from run_schema import parse_header
+
+SEGMENT = 512  # Samples per Welch segment, about 2 s (0.5 Hz resolution) at the logged row rate
+BLOCK_SEGMENTS = 256  # Segments transformed per FFT call, small enough to stay in cache
+
+
+def header_rates(header):
+    # Sample rates from a run header such as "RS:1000:rear_sus,FS:1000:front_sus", keyed by channel code
+    return {channel.code: channel.rate for channel in parse_header(header)}
+
+
+def sample_rate(count, timeOfRun, header=""):
+    # Rows logged per second. The header gives the sensor rate, which rows are logged well below, so it is only used without a footer
+    if count and timeOfRun:
+        return count / timeOfRun
+    rates = header_rates(header)
+    return float(rates.get("RS") or rates.get("FS") or 1)
+
+
+def welch(signals, fs, segment=SEGMENT):
+    # One-sided PSD of each row of signals (channels x samples): Hann window, 50 % overlap, mean removed per segment
+    # Returns frequencies and PSD (channels x frequencies), both empty when the run is shorter than one segment
+    signals = np.atleast_2d(np.asarray(signals, dtype=np.float32))
+    if signals.shape[1] < segment:
+        return np.zeros(0), np.zeros((len(signals), 0))
+    window = np.hanning(segment).astype(np.float32)
+    frames = sliding_window_view(signals, segment, axis=1)[:, ::segment // 2]  # View, no copy of the samples
+    total = np.zeros((len(signals), segment // 2 + 1))
+    for start in range(0, frames.shape[1], BLOCK_SEGMENTS):
+        block = frames[:, start:start + BLOCK_SEGMENTS]
+        block = (block - block.mean(axis=2, keepdims=True)) * window
+        spectrum = np.fft.rfft(block, axis=2)
+        total += (spectrum.real ** 2 + spectrum.imag ** 2).sum(axis=1)
+    psd = total / (frames.shape[1] * fs * np.sum(window.astype(np.float64) ** 2))
+    psd[:, 1:(segment + 1) // 2] *= 2  # Fold negative frequencies, DC and Nyquist appear once
+    return np.fft.rfftfreq(segment, 1 / fs), psd
+
+
+@dataclass(slots=True)
+class RunSpectra:
+    # PSD per frequency bin. accel sums the three chassis axes, the ratios are travel per unit chassis acceleration
+    frequencies: np.ndarray  # Hz
+    fork: np.ndarray  # %^2/Hz
+    shock: np.ndarray
+    accel: np.ndarray  # (m/s^2)^2/Hz
+    forkRatio: np.ndarray  # % per m/s^2
+    shockRatio: np.ndarray
+    sampleRate: float
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.__slots__ if isinstance(getattr(self, name), np.ndarray))
+
+
+@instrumented("spectrum", samples=lambda args, result: len(args[0]))
+def run_spectra(fork, shock, accel, fs, segment=SEGMENT):
+    # Spectra of fork and shock travel (%) and chassis acceleration (samples x 3 axes) in one batched Welch pass
+    frequencies, psd = welch(np.vstack([fork, shock, np.asarray(accel).T]), fs, segment)
+    accel_psd = psd[2:].sum(axis=0)
+    ratios = [np.sqrt(np.divide(psd[i], accel_psd, out=np.full_like(accel_psd, np.nan), where=accel_psd > 0)) for i in (0, 1)]
+    return RunSpectra(frequencies, psd[0], psd[1], accel_psd, ratios[0], ratios[1], fs)
@@ -0,0 +1,64 @@
+# startup_benchmark.py
+# Measures import time of the headless core and cold start of 0w2_runner against the Pi Zero 2 W budget
+# Usage: python startup_benchmark.py [--repeats 5] [--import-budget 1.5] [--cold-start-budget 3.0]
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+IMPORT_BUDGET_S = 1.5  # Import of accelerometer_data_processor on the Pi, numpy dominates
+COLD_START_BUDGET_S = 3.0  # Full 0w2_runner run on the default test run
+PLOTTING_MODULES = ("bokeh", "tornado", "jinja2", "PIL")
+
+
+def time_command(command, repeats):
+    # Wall times of fresh interpreter runs, so nothing is already imported or cached in memory
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def plotting_imports():
+    # Plotting modules pulled in by importing the core, should be none
+    check = f"import sys, accelerometer_data_processor; print(' '.join(sorted({{m.split('.')[0] for m in sys.modules}} & set({PLOTTING_MODULES!r}))))"
+    return subprocess.run([sys.executable, "-c", check], check=True, capture_output=True, text=True).stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time and cold-start benchmark for the headless runner")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET_S)
+    parser.add_argument("--cold-start-budget", type=float, default=COLD_START_BUDGET_S)
+    args = parser.parse_args()
+
+    baseline = time_command([sys.executable, "-c", "pass"], args.repeats)
+    core_import = time_command([sys.executable, "-c", "import accelerometer_data_processor"], args.repeats)
+    cold_start = time_command([sys.executable, "0w2_runner.py"], args.repeats)
+    leaked = plotting_imports()
+
+    results = [
+        ("interpreter", baseline, None),
+        ("core import", core_import, args.import_budget),
+        ("0w2 cold start", cold_start, args.cold_start_budget),
+    ]
+    over_budget = bool(leaked)
+    for name, times, budget in results:
+        median = statistics.median(times)
+        status = ""
+        if budget is not None:
+            status = "OK" if median <= budget else "OVER BUDGET"
+            over_budget = over_budget or median > budget
+        budget_text = f"  budget {budget:.2f}s  {status}" if budget is not None else ""
+        print(f"{name:<16} median {median:.3f}s  min {min(times):.3f}s{budget_text}")
+    print(f"plotting modules imported by core: {' '.join(leaked) if leaked else 'none'}")
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+# workers.py
+# Worker pool for the Bokeh apps: run processing happens off the server event loop so one large run never freezes other sessions
+# Identical requests in flight at the same time (from any session) share one computation
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
+import threading
+
+
+class CoalescingPool:
+    # Thread pool where a request whose key is already being computed joins the running future instead of starting another
+    def __init__(self, max_workers=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count(), thread_name_prefix="run-worker")
+        self.in_flight = {}  # key -> Future
+        self.lock = threading.RLock()
+
+    def submit(self, key, fn, *args):
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                future = self.executor.submit(fn, *args)
+                self.in_flight[key] = future
+                future.add_done_callback(partial(self._finished, key))
+        return future
+
+    def _finished(self, key, future):
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+
+
+def run_in_background(document, key, fn, args, done):
+    # Runs fn(*args) on the pool, then done(future) on the document's event loop, the only place allowed to change the document
+    future = pool.submit(key, fn, *args)
+    future.add_done_callback(lambda future: document.add_next_tick_callback(partial(done, future)))
+    return future
+
+
+# Shared by every session of a Bokeh server process
+pool = CoalescingPool()